@@ -8,17 +8,30 @@ def get_train_args(allow_unmatched_args=False):
     parser.add_argument('--base_dir', type=str, default='runs/test')
     parser.add_argument('--bleu_every', type=int, default=0)
     parser.add_argument('--save_every', type=int, default=50)
+    parser.add_argument('--checkpoint_every', type=int, default=1, help='epochs between full training state checkpoints')
+    parser.add_argument('--keep_checkpoints', type=int, default=3)
+    parser.add_argument('--keep_checkpoints_mb', type=int, default=0, help='also prune old checkpoints above this total size. 0 : no limit')
+    parser.add_argument('--resume', type=str, default=None, 
+                        help='checkpoint to resume training from, or "latest" for the last one in base_dir')
     parser.add_argument('--test_every', type=int, default=2)
+    parser.add_argument('--log_backend', type=str, default='async', choices=['sync', 'async', 'none'], 
+                        help='tensorboard logging : on the training thread, in a background thread, or disabled')
 
     # MODEL args
     parser.add_argument('--rnn', type=str, default='LSTM', choices=['LSTM', 'GRU'])
     parser.add_argument('--hidden_dim_disc', type=int, default=512)
     parser.add_argument('--hidden_dim_gen', type=int, default=512)
-    parser.add_argument('--num_layers_disc', type=int, default=2)
-    parser.add_argument('--num_layers_gen', type=int, default=2)
+    parser.add_argument('--num_layers_disc', type=int, default=2, 
+                        help='with more than 1 layer, teacher forced passes still step through time in python')
+    parser.add_argument('--num_layers_gen', type=int, default=2, 
+                        help='with more than 1 layer, teacher forced passes still step through time in python')
     parser.add_argument('--var_dropout_p_gen', type=float, default=0.5)
     parser.add_argument('--var_dropout_p_disc', type=float, default=0.5)
     parser.add_argument('--gamma', type=float, default=0.95)
+    parser.add_argument('--output_layer', type=str, default='dense', choices=['dense', 'adaptive', 'sampled'], 
+                        help='generator softmax. sampled : dense layer trained with a sampled softmax')
+    parser.add_argument('--adaptive_cutoffs', type=int, nargs='+', default=[2000, 10000])
+    parser.add_argument('--num_sampled', type=int, default=1024, help='negative words for the sampled softmax')
     parser.add_argument('--load_gen_path', type=str, default=None)
     parser.add_argument('--load_disc_path', type=str, default=None)
 
@@ -34,6 +47,11 @@ def get_train_args(allow_unmatched_args=False):
     parser.add_argument('--seqgan_reward', type=int, default=0, help='reward is only at the final timestep')
     parser.add_argument('--leak_info', action='store_true', help='give the generator access to disc. state')
     parser.add_argument('--use_baseline', type=int, default=1)
+    parser.add_argument('--rollout_workers', type=int, default=0, 
+                        help='processes sampling the fake sentences of adversarial training (0 : sample in the training loop)')
+    parser.add_argument('--rollout_sync_every', type=int, default=1, help='generator updates between weight syncs to the rollout workers')
+    parser.add_argument('--max_staleness', type=int, default=4, help='drop rollouts sampled with weights more than this many generator updates old')
+    parser.add_argument('--is_clip', type=float, default=1., help='truncation of the importance weights of stale rollouts')
     parser.add_argument('--disc_train_iterations', '-dti', type=int, default=5) 
     parser.add_argument('--gen_train_iterations',  '-gti', type=int, default=1) 
     parser.add_argument('--mle_train_iterations',  '-mti', type=int, default=0) 
@@ -49,10 +67,17 @@ def get_train_args(allow_unmatched_args=False):
     parser.add_argument('--stream_data', action='store_true', default=False)
     parser.add_argument('--max_seq_len', type=int, default=51)
     parser.add_argument('--mask_padding', action='store_true', default=False)
+    parser.add_argument('--bucket_batches', action='store_true', default=False, help='batch sentences of similar length')
     parser.add_argument('--character_level', action='store_true', default=False)
+    parser.add_argument('--prefetch_depth', type=int, default=2, help='batches built ahead by a background thread (0 to disable)')
+    parser.add_argument('--pin_memory', action='store_true', default=False)
 
     # OTHER args
     parser.add_argument('--no_cuda', action='store_true')
+    parser.add_argument('--distributed', action='store_true', default=False, 
+                        help='data parallel training over the processes launched by torchrun (gloo backend). '
+                             'every process trains on batches of batch_size')
+    parser.add_argument('--num_threads', type=int, default=0, help='torch threads per process. 0 : split the cores between processes')
     parser.add_argument('--transfer_weights_after_pretraining', type=int, default=1)
     parser.add_argument('--sample_size_fast', type=int, default=500)
     parser.add_argument('--lm_path', type=str, default='trained_models/news/word/best_mle')
@@ -94,8 +119,20 @@ def get_test_args():
     parser.add_argument('--n_iter', type=int, default=10, help="number of tsne iterations")
     parser.add_argument('--tsne_perp', type=int, default=30, help="perplexity in TSNE")
     parser.add_argument('--oracle_nll_log_every', type=int, default=2)
+    parser.add_argument('--log_backend', type=str, default='async', choices=['sync', 'async', 'none'])
     parser.add_argument('--alpha_test', type=float, default=1.0)
+    parser.add_argument('--top_k', type=int, default=0, help='sample among the k most likely words (0 : all)')
+    parser.add_argument('--top_p', type=float, default=1.0, help='nucleus sampling mass')
+    parser.add_argument('--typical_p', type=float, default=1.0, help='typical sampling mass')
+    parser.add_argument('--sweep', type=str, default='temperature', choices=['temperature', 'top_k', 'top_p', 'typical_p'], 
+                        help='decoding knob swept in score_models.py')
+    parser.add_argument('--decoding', type=str, default='sample', choices=['sample', 'greedy', 'beam'], 
+                        help='decoder used for sentence completion (--run_sc)')
+    parser.add_argument('--beam_size', type=int, default=5)
+    parser.add_argument('--length_penalty', type=float, default=1.0, help='beam scores are divided by length ** _')
     parser.add_argument('--breakpoint', type=int, default=8, help="sentence completion breakpoint")
+    parser.add_argument('--breakpoints', type=int, nargs='+', default=None, help="sweep over several breakpoints")
+    parser.add_argument('--prefix_cache_mb', type=int, default=1024, help="memory bound of the prefix state cache")
     parser.add_argument('--n_grams', nargs="+", type=int)
     parser.add_argument('--use_conv_net', action='store_true')
     parser.add_argument('--classify_embeddings', action='store_true')
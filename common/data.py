@@ -1,16 +1,36 @@
+import hashlib
+import io
+import locale
+import multiprocessing
 import os
 import pdb
 import numpy as np
 import re
+import shutil
 import torch
 from torch.autograd import Variable
 import _pickle as pickle
 
+# special tokens, see `Dictionary`
+PAD_token = 0
+EOS_token = 1
+SOS_token = 2
+
+TOKEN_RE = re.compile(r"[\w']+|[.,!?;]", flags=re.UNICODE)
+MIN_CHUNK_BYTES = 1 << 22 # don't bother spawning workers for less than 4MB of text
+
+# preprocessing cache (see `tokenize`)
+CACHE_DIRNAME   = '.tokenize_cache'
+CACHE_VERSION   = 3 # v2 : word counts in the dictionary, v3 : keyed on file size / mtime
+CACHE_MAX_BYTES = 1 << 32
+CACHE_CONTENT_FILE = 'content_key' # hash of the source file and options, see `tokenize`
+
 class Dictionary(object):
     def __init__(self):
         self.word2idx = {}
         self.idx2word = []
         self.vocab_set = set()
+        self.counts = np.zeros(0, dtype=np.int64) # training set frequencies, see `tokenize`
 
         # add <unk> <sos> and <eos> tokens
         # really important not to change (hardcoded in minibatch_generator)
@@ -28,123 +48,276 @@ class Dictionary(object):
     def __len__(self):
         return len(self.idx2word)
 
-def tokenize(path, train=False, word_dict=None, char_level=False, dataset=None, skip=False):
-    # tokenizing process is somewhat lenghty. Let's try to avoid 
-    # it when possible
-    if not skip:
-        try:
-            path_word_dict = path + '_word_dict.pickle'
-            path_ids = path + '_ids.pickle'
-            with open(path_ids, 'rb') as f: 
-                ids = pickle.load(f)
-            if train: 
-                with open(path_word_dict, 'rb') as f: 
-                    word_dict = pickle.load(f)
-            
-            print('loaded preprocessed data from %s' % path)
-            return ids, word_dict
-        except: 
-            pass
+
+class Corpus(object):
+    """
+    Tokenized sentences, stored as one flat int32 token array and int64 offsets : sentence i 
+    is tokens[offsets[i]:offsets[i+1]]. Both arrays are memory-mapped when loaded from disk, 
+    and indexing returns views (no copies).
+    """
+    def __init__(self, tokens, offsets):
+        self.tokens  = tokens
+        self.offsets = offsets
+        self.lengths = np.diff(offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def save(self, path):
+        np.save(path + '_tokens.npy',  self.tokens)
+        np.save(path + '_offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        tokens  = np.load(path + '_tokens.npy',  mmap_mode='r')
+        offsets = np.load(path + '_offsets.npy', mmap_mode='r')
+        return cls(tokens, offsets)
+
+def tokenize(path, train=False, word_dict=None, char_level=False, dataset=None, skip=False, 
+             num_workers=None, cache_dir=None, max_cache_bytes=CACHE_MAX_BYTES):
+    # tokenizing process is somewhat lenghty. Let's try to avoid it when possible. 
+    # Cache entries are keyed by the file's path, size and mtime and by the options, so a hit never 
+    # reads the file. Every entry also stores the hash of the file content : when the size / mtime 
+    # changed (or the file moved), the file is hashed and an entry of the same content is reused
+    assert os.path.exists(path), '{} does not exist'.format(path)
+    cache_dir = cache_dir or os.path.join(os.path.dirname(path), CACHE_DIRNAME)
+    options = _options_key(train, word_dict, char_level, dataset)
+    key = _cache_key(path, options)
+    entry = os.path.join(cache_dir, key)
+
+    if not skip and os.path.isdir(entry):
+        return _load_entry(entry, train, word_dict)
+
+    content_key = _content_key(path, options)
+    same_content = None if skip else _find_entry(cache_dir, content_key)
+    if same_content is not None: 
+        # hard links : the files are shared, and the new entry survives the eviction of the old one
+        tmp_entry = '{}.tmp{}'.format(entry, os.getpid())
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name in os.listdir(same_content): 
+            try: 
+                os.link(os.path.join(same_content, name), os.path.join(tmp_entry, name))
+            except OSError: 
+                shutil.copy(os.path.join(same_content, name), os.path.join(tmp_entry, name))
+        _publish_entry(tmp_entry, entry)
+        return _load_entry(entry, train, word_dict)
 
     """Tokenizes a text file."""
     if word_dict is None : 
         print('creating new word dictionary')
         word_dict = Dictionary() 
-    assert os.path.exists(path), '{} does not exist'.format(path)
-    # Add words to the dictionary
-    with open(path, 'r') as f:
-        sentences = 0
-        max_tokens = 0
-        for line in f:
-            # line = line.decode('utf-8', 'strict')
-            words = re.findall(r"[\w']+|[.,!?;]", line,
-                    flags=re.UNICODE) 
-            
-            if char_level: 
-                chars = []
-                for word in words: 
-                    for cc in word: 
-                        chars += [cc]
-                    chars += [' ']
-            
-                # remove last space
-                chars = chars[:-1]
-                words = chars
-            else: 
-                if words[-1] == '.':
-                    words[-1] = '<eos>'
-                elif words[-1] == '?':
-                    words[-1] =  '<qm>'
-                elif words[-1] == '!':
-                    words[-1]  ='<em>'
-            
-            if dataset=='ptb':
-                words += ['<eos>']
-
-                
-            # only add words if in training set
-            if train:
-                for word in words:
-                    word_dict.add_word(word)
-                word_dict.vocab_set = \
-                    set(word_dict.idx2word)
-
-            # track stats for building tokenized version
-            tokens = len(words)
-            sentences += 1
-            if tokens > max_tokens:
-                max_tokens = tokens
-
-    # Tokenize file content
-    with open(path, 'r') as f:
-        ids = []
-        for i, line in enumerate(f):
-            # line = line.decode('utf-8', 'strict')
-            words = re.findall(r"[\w']+|[.,!?;]", line, 
-                    flags=re.UNICODE)
-            
-            if char_level: 
-                chars = []
-                for word in words: 
-                    for cc in word: 
-                        chars += [cc]
-                    chars += [' ']
-            
-                # remove last space
-                chars = chars[:-1]
-                words = chars
-            else: 
-                if words[-1] == '.':
-                    words[-1] = '<eos>'
-                elif words[-1] == '?':
-                    words[-1] =  '<qm>'
-                elif words[-1] == '!':
-                    words[-1]  ='<em>'
-
-            if dataset=='ptb':
-                words += ['<eos>']
-
-            token = 0
-            idx = list(range(len(words)))
-            for word in words:
-                if word not in word_dict.vocab_set:
-                    word = u'<unk>'
-                idx[token] = word_dict.word2idx[word]
-                token += 1
-
-            # create list of lists for easier process later on
-            ids.append(idx)
-
-    # save to file 
-    path_word_dict = path + '_word_dict.pickle'
-    path_ids = path + '_ids.pickle'
-    with open(path_ids, 'wb') as f: 
-        pickle.dump(ids, f)
+
+    # a single pass over the file, split in byte ranges processed in parallel. 
+    # Every chunk returns its own vocabulary (in order of appearance), so merging them 
+    # in file order gives exactly the word ids of a sequential pass.
+    jobs = [(path, start, end, char_level, dataset) for (start, end) in \
+                _chunk_boundaries(path, num_workers)]
+    if len(jobs) > 1: 
+        with multiprocessing.Pool(len(jobs)) as pool: 
+            chunks = pool.map(_tokenize_chunk, jobs)
+    else: 
+        chunks = [_tokenize_chunk(job) for job in jobs]
+
+    unk = word_dict.word2idx[u'<unk>']
+    tokens, lengths = [], []
+    for chunk_words, chunk_ids, chunk_lengths in chunks: 
+        # only add words if in training set
+        if train: 
+            mapping = [word_dict.add_word(word) for word in chunk_words]
+        else: 
+            mapping = [word_dict.word2idx[word] if word in word_dict.vocab_set else unk \
+                        for word in chunk_words]
+
+        tokens  += [np.asarray(mapping, dtype=np.int32)[chunk_ids]]
+        lengths += [chunk_lengths]
+
+    if train: 
+        word_dict.vocab_set = set(word_dict.idx2word)
+        counts = sum(np.bincount(x, minlength=len(word_dict)) for x in tokens)
+        old_counts = word_counts(word_dict)
+        counts[:len(old_counts)] += old_counts
+        word_dict.counts = counts
+
+    offsets = np.zeros(sum(len(x) for x in lengths) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(lengths), out=offsets[1:])
+
+    # save to the cache (written to a temporary directory first, so entries are always complete), 
+    # and reload as a memory map
+    tmp_entry = '{}.tmp{}'.format(entry, os.getpid())
+    os.makedirs(tmp_entry, exist_ok=True)
+    Corpus(np.concatenate(tokens), offsets).save(os.path.join(tmp_entry, 'corpus'))
     if train: 
-        with open(path_word_dict, 'wb') as f: 
+        with open(os.path.join(tmp_entry, 'word_dict.pickle'), 'wb') as f: 
             pickle.dump(word_dict, f)
+    with open(os.path.join(tmp_entry, CACHE_CONTENT_FILE), 'w') as f: 
+        f.write(content_key)
+
+    _publish_entry(tmp_entry, entry)
+    _evict_cache(cache_dir, max_cache_bytes, keep=key)
+
+    ids = Corpus.load(os.path.join(entry, 'corpus'))
+    return ids, word_dict
+
+
+def word_counts(word_dict, dataset=None):
+    # frequency of every word. Dictionaries pickled before counts were tracked only have them 
+    # if the training `dataset` (a `Corpus`) is given
+    counts = getattr(word_dict, 'counts', None)
+    if counts is None or len(counts) == 0: 
+        if dataset is None: 
+            return np.zeros(0, dtype=np.int64)
+        counts = np.bincount(dataset.tokens, minlength=len(word_dict))
+    return counts
+
+
+def _options_key(train, word_dict, char_level, dataset):
+    # (tokenizer options, vocabulary) fingerprint
+    h = hashlib.sha1()
+    options = 'v{} train={} char_level={} ptb={}'.format(CACHE_VERSION, bool(train), bool(char_level), \
+                dataset == 'ptb')
+    h.update(options.encode('utf-8'))
+
+    if word_dict is not None: 
+        h.update(u'\n'.join(word_dict.idx2word).encode('utf-8'))
+        h.update(u'\t'.join(sorted(word_dict.vocab_set)).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def _cache_key(path, options):
+    # (file path / size / mtime, options) fingerprint : the file itself is not read
+    stat = os.stat(path)
+    key = u'{}\t{}\t{}\t{}'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns, options)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _content_key(path, options):
+    # (file content, options) fingerprint
+    h = hashlib.sha1()
+    with open(path, 'rb') as f: 
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update(options.encode('utf-8'))
+    return h.hexdigest()
+
+
+def _find_entry(cache_dir, content_key):
+    # published entry built from the same content and options, if any
+    if not os.path.isdir(cache_dir): return None
+    for name in os.listdir(cache_dir): 
+        entry = os.path.join(cache_dir, name)
+        if '.tmp' in name or not os.path.isdir(entry): continue
+        try: 
+            with open(os.path.join(entry, CACHE_CONTENT_FILE), 'r') as f: 
+                if f.read() == content_key: return entry
+        except OSError: 
+            continue # e.g. evicted meanwhile
+    return None
+
+
+def _load_entry(entry, train, word_dict):
+    ids = Corpus.load(os.path.join(entry, 'corpus'))
+    if train: 
+        with open(os.path.join(entry, 'word_dict.pickle'), 'rb') as f: 
+            word_dict = pickle.load(f)
     
+    os.utime(entry) # mark as recently used
+    print('loaded preprocessed data from %s' % entry)
     return ids, word_dict
+
+
+def _publish_entry(tmp_entry, entry):
+    # several processes may publish the same entry at once (e.g. every rank of a distributed run). 
+    # Entries only depend on their key, so the first one wins and the others are discarded. A 
+    # published entry is never removed here, as another process may be reading it
+    if os.path.isdir(entry): 
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+    else: 
+        try: 
+            os.rename(tmp_entry, entry)
+        except OSError: 
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def _evict_cache(cache_dir, max_bytes, keep=None):
+    # remove the least recently used entries until the cache fits in `max_bytes`
+    entries = []
+    for name in os.listdir(cache_dir): 
+        entry = os.path.join(cache_dir, name)
+        if '.tmp' in name or not os.path.isdir(entry): continue
+        size = sum(os.path.getsize(os.path.join(entry, x)) for x in os.listdir(entry))
+        entries += [(os.path.getmtime(entry), size, name)]
+
+    total = sum(size for (_, size, _) in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes: break
+        if name == keep: continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
+        print('evicted %s from the preprocessing cache' % name)
+
+
+def split_line(line, char_level=False, dataset=None):
+    words = TOKEN_RE.findall(line)
+    
+    if char_level: 
+        # characters of every word, separated by a space
+        words = list(' '.join(words))
+    else: 
+        if words[-1] == '.':
+            words[-1] = '<eos>'
+        elif words[-1] == '?':
+            words[-1] =  '<qm>'
+        elif words[-1] == '!':
+            words[-1]  ='<em>'
+    
+    if dataset=='ptb':
+        words += ['<eos>']
+
+    return words
+
+
+def _chunk_boundaries(path, num_workers=None):
+    # split the file in byte ranges of at least MIN_CHUNK_BYTES, each ending on a line break
+    size = os.path.getsize(path)
+    num_workers = num_workers or os.cpu_count() or 1
+    num_chunks = max(1, min(num_workers, size // MIN_CHUNK_BYTES))
+
+    bounds = [0]
+    with open(path, 'rb') as f: 
+        for i in range(1, num_chunks): 
+            f.seek(max(size * i // num_chunks, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+
+    ranges = [(start, end) for (start, end) in zip(bounds[:-1], bounds[1:]) if end > start]
+    return ranges or [(0, size)]
+
+
+def _tokenize_chunk(job):
+    # returns the chunk's vocabulary, its words as local ids and the length of every line
+    path, start, end, char_level, dataset = job
+    with open(path, 'rb') as f: 
+        f.seek(start)
+        raw = f.read(end - start)
+
+    vocab, ids, lengths = {}, [], []
+    # same line splitting (and decoding) as iterating over open(path, 'r')
+    for line in io.TextIOWrapper(io.BytesIO(raw), encoding=locale.getpreferredencoding(False)):
+        words = split_line(line, char_level=char_level, dataset=dataset)
+        ids.extend([vocab.setdefault(word, len(vocab)) for word in words])
+        lengths.append(len(words))
+
+    words = sorted(vocab, key=vocab.get)
+    return words, np.array(ids, dtype=np.int64), np.array(lengths, dtype=np.int64)
     
 
 if __name__ == '__main__':
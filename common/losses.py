@@ -8,20 +8,62 @@ import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn import functional as F
 from torch.distributions import Categorical
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
+
+LOSS_CHUNK_SIZE = 1024 # rows of logits, see `TokenNLL`
+
+class TokenNLL(torch.autograd.Function):
+    ''' -log_softmax(logits)[target] for every row of logits (N x vocab_size), as logsumexp minus 
+        the target logit. Rows are processed `chunk_size` at a time, and only the N logsumexps are 
+        kept for the backward pass : the N x vocab_size log-probs are never materialized '''
+    @staticmethod
+    def forward(ctx, logits, target, chunk_size):
+        lse = logits.new(logits.size(0))
+        for i in range(0, logits.size(0), chunk_size):
+            lse[i:i+chunk_size] = torch.logsumexp(logits[i:i+chunk_size], dim=1)
+
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(logits, target, lse)
+        return lse - logits.gather(1, target.unsqueeze(1)).squeeze(1)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # d nll / d logits = softmax(logits) - one_hot(target)
+        logits, target, lse = ctx.saved_tensors
+        grad = torch.empty_like(logits)
+        for i in range(0, logits.size(0), ctx.chunk_size):
+            j = i + ctx.chunk_size
+            torch.exp(logits[i:j] - lse[i:j].unsqueeze(1), out=grad[i:j])
+            grad[i:j] *= grad_output[i:j].unsqueeze(1)
+
+        grad.scatter_add_(1, target.unsqueeze(1), -grad_output.unsqueeze(1))
+        return grad, None, None
+
+
+def token_nll(logits, target, chunk_size=LOSS_CHUNK_SIZE):
+    # logits : FloatTensor ... x vocab_size
+    # target : LongTensor  ... 
+    # returns the nll of every target, same shape as target
+    flat_logits = logits.reshape(-1, logits.size(-1)).contiguous()
+    nll = TokenNLL.apply(flat_logits, target.reshape(-1).contiguous(), chunk_size)
+    return nll.view(target.shape)
+
 
 def masked_cross_entropy(logits, target, length):
-    # logits : FloatTensor bs x seq_len x vocab_size
+    # logits : FloatTensor bs x seq_len x vocab_size, or PackedSequence (valid positions only)
     # target : LongTensor  bs x seq_len
     # length : LongTensor  bs 
     
+    if isinstance(logits, PackedSequence): 
+        target = pack_padded_sequence(target, length.tolist(), batch_first=True).data
+        return token_nll(logits.data, target).sum() / length.float().sum()
+
     bs, seq_len, vocab_size  = logits.size()
     mask = torch.arange(seq_len).unsqueeze(0).expand(bs, -1).long()
     if length.is_cuda : mask = mask.cuda()
     mask = mask  < length.unsqueeze(1).expand(-1, seq_len)
 
-    log_probs = F.log_softmax(logits, dim=2)
-    log_probs = torch.gather(log_probs, 2, target.unsqueeze(2)).squeeze(2)
-    loss = - (log_probs * Variable(mask.float())).sum(dim=1)
+    loss = (token_nll(logits, target) * Variable(mask.float())).sum(dim=1)
     return loss.sum() / length.float().sum()
 
 
@@ -29,11 +71,13 @@ def reinforce_critic_loss(cumulative_rewards, fake_baselines):
     return F.mse_loss(fake_baselines, cumulative_rewards.detach())
 
 
-def reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, baseline, args):
+def reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, baseline, args, 
+                       is_weights=None):
     # cumulative rewards : bs x seq_len             
     # fake logits        : bs x seq_len x vocab_size  (distribution @ every timestep)
     # fake sentence      : bs x seq_len               (indices for the words)
     # baseline           : bs x seq_len               (baseline coming from critic)
+    # is weights         : bs x seq_len               (optional, importance weights of off-policy samples)
     assert cumulative_rewards.shape == baseline.shape == fake_sentence.shape
 
     bs, seq_len, vocab_size = fake_logits.shape
@@ -46,14 +90,21 @@ def reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, baseline,
         advantages = torch.clamp(advantages, -args.adv_clip, args.adv_clip)
     advantages.detach()
 
-    loss = 0.
-    for t in range(seq_len):
-        dist = Categorical(logits=fake_logits[:, t])
-        log_prob = dist.log_prob(fake_sentence[:, t])
-        ment_reg = args.beta * dist.entropy()
-        loss += log_prob * advantages[:, t] + ment_reg
+    # single log_softmax over every timestep, instead of one Categorical per timestep
+    log_probs = F.log_softmax(fake_logits, dim=2)
+    log_prob  = torch.gather(log_probs, 2, fake_sentence.unsqueeze(2)).squeeze(2)
+    entropy   = -(log_probs.exp() * log_probs).sum(dim=2)
+
+    if is_weights is not None: 
+        advantages = advantages * is_weights
+
+    loss = log_prob * advantages + args.beta * entropy
     return -loss.sum() / bs # average loss over batches
 
+def truncated_importance_weights(log_prob, behaviour_log_prob, clip):
+    # per word min(clip, pi / mu). Both log-probs must be computed the same way (e.g. without dropout)
+    return torch.exp(log_prob - behaviour_log_prob).clamp(max=clip).detach()
+
 def cot_gen_loss(gen_logits, med_logits):
     '''
     gen_logits: (bs, seq_len, vocab_size)
@@ -96,6 +147,71 @@ def KLD(p_logits, q_logits):
 
 def NLL(logits, target):
     assert logits.shape[:-1] == target.shape
-    log_probs = F.log_softmax(logits, dim=-1)
-    nll = torch.gather(log_probs, 2, target.unsqueeze(2))
-    return -1 * nll.mean()
+    return token_nll(logits, target).mean()
+
+
+if __name__ == '__main__':
+    # micro-benchmark : generator update loss, vectorized vs. one Categorical per timestep
+    from argparse import Namespace
+    args = Namespace(use_baseline=1, adv_clip=5., beta=1.)
+    bs, seq_len, vocab_size = 128, 51, 5000
+
+    def categorical_loop(cumulative_rewards, fake_logits, fake_sentence, baseline, args):
+        advantages = torch.clamp(cumulative_rewards - baseline, -args.adv_clip, args.adv_clip)
+        loss = 0.
+        for t in range(fake_logits.size(1)):
+            dist = Categorical(logits=fake_logits[:, t])
+            loss += dist.log_prob(fake_sentence[:, t]) * advantages[:, t] + args.beta * dist.entropy()
+        return -loss.sum() / fake_logits.size(0)
+
+    # (both get the same inputs, and must give the same loss and gradients)
+    logits = torch.randn(bs, seq_len, vocab_size, requires_grad=True)
+    sentence = torch.randint(0, vocab_size, (bs, seq_len)).long()
+    rewards, baseline = torch.randn(bs, seq_len), torch.randn(bs, seq_len)
+    results = []
+    for name, fn in [('categorical loop', categorical_loop), ('vectorized', reinforce_gen_loss)]:
+        start = time.time()
+        for _ in range(10):
+            logits.grad = None
+            loss = fn(rewards.clone(), logits, sentence, baseline, args)
+            loss.backward()
+        print('{:<20} {:.2f} ms / update'.format(name, (time.time() - start) * 100))
+        results += [(loss.detach(), logits.grad.clone())]
+
+    assert torch.allclose(results[0][0], results[1][0], rtol=1e-4, atol=1e-4)
+    assert torch.allclose(results[0][1], results[1][1], rtol=1e-4, atol=1e-6)
+
+    # chunked nll vs. full log_softmax + gather : same loss and gradients
+    logits = torch.randn(bs, seq_len, vocab_size, requires_grad=True)
+    target = torch.randint(0, vocab_size, (bs, seq_len)).long()
+    grads = []
+    for name, fn in [('log_softmax + gather', lambda l, t: -F.log_softmax(l, 2).gather(2, t.unsqueeze(2)).mean()), 
+                     ('chunked', NLL)]:
+        logits.grad = None
+        start = time.time()
+        loss = fn(logits, target)
+        loss.backward()
+        grads += [(loss.item(), logits.grad.clone())]
+        print('{:<20} {:.2f} ms / update'.format(name, (time.time() - start) * 1000))
+
+    assert abs(grads[0][0] - grads[1][0]) < 1e-4 and (grads[0][1] - grads[1][1]).abs().max() < 1e-6
+
+    # per token : against F.cross_entropy, over a number of rows that isn't a multiple of the chunk size
+    n_rows = LOSS_CHUNK_SIZE + 477
+    logits = torch.randn(n_rows, vocab_size, requires_grad=True)
+    target = torch.randint(0, vocab_size, (n_rows,)).long()
+    weights = torch.rand(n_rows)
+    results = []
+    for fn in [lambda l, t: F.cross_entropy(l, t, reduction='none'), token_nll]:
+        logits.grad = None
+        nll = fn(logits, target)
+        (nll * weights).sum().backward()
+        results += [(nll.detach(), logits.grad.clone())]
+    assert torch.allclose(results[0][0], results[1][0], atol=1e-4)
+    assert torch.allclose(results[0][1], results[1][1], atol=1e-6)
+
+    # and the analytical gradient, in double precision (with a chunk that doesn't divide the rows)
+    logits = torch.randn(7, 5, dtype=torch.double, requires_grad=True)
+    target = torch.randint(0, 5, (7,)).long()
+    assert torch.autograd.gradcheck(lambda l: TokenNLL.apply(l, target, 3), (logits,))
+    print('token nll matches F.cross_entropy')
@@ -3,10 +3,13 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from collections import OrderedDict
 from pydoc import locate
 from torch.distributions import Categorical
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence, pad_packed_sequence
 
 from utils import * 
+from losses import masked_cross_entropy
 
 '''
 General Class Wrapper around RNNs that supports variational dropout
@@ -40,37 +43,388 @@ class Model(nn.Module):
 
         return output, hidden_state 
 
+    def run(self, x, hidden_state=None, var_drop_p=0.5, lengths=None):
+        ''' teacher forced equivalent of calling `step` on every timestep of x (bs x seq_len x h). 
+            With `lengths` (sorted in decreasing order), <pad> positions are skipped and the output 
+            is a PackedSequence. Only 1 layer models run in a single (cudnn) call, deeper ones 
+            still loop over timesteps '''
+        if lengths is not None: 
+            return self.run_packed(x, lengths, hidden_state, var_drop_p=var_drop_p)
+
+        if len(self.rnns) > 1: 
+            # `step` feeds the hidden state of layer l to layer l+1 (and the one of the last layer 
+            # to the first layer at the next timestep), so layers can't be unrolled independently
+            outputs = []
+            for t in range(x.size(1)):
+                output, hidden_state = self.step(x[:, [t]], hidden_state, t, var_drop_p=var_drop_p)
+                outputs += [output]
+            return torch.cat(outputs, dim=1), hidden_state
+
+        if self.training and var_drop_p > 0.: 
+            # same mask as the one `step` creates at t == 0, broadcasted over time
+            self.mask = x.data.new(x.size(0), 1, x.size(2)).bernoulli_(1 - var_drop_p)
+            self.mask = Variable(self.mask, requires_grad=False) / (1 - var_drop_p)
+
+        output = x * self.mask if self.training and var_drop_p > 0. else x
+        output, hidden_state = self.rnns[0](output, hidden_state)
+        if self.training and var_drop_p > 0: output = output * self.mask
+
+        return output, hidden_state
+
+    def run_packed(self, x, lengths, hidden_state=None, var_drop_p=0.5):
+        ''' `run` on the valid timesteps only. Returns a PackedSequence, and the hidden state 
+            of every sentence at its last valid timestep '''
+        bs, seq_len = x.size(0), x.size(1)
+        lengths = lengths.clamp(1, seq_len).tolist() if torch.is_tensor(lengths) else lengths
+        dropout = self.training and var_drop_p > 0.
+        if dropout: 
+            self.mask = x.data.new(bs, 1, x.size(2)).bernoulli_(1 - var_drop_p)
+            self.mask = Variable(self.mask, requires_grad=False) / (1 - var_drop_p)
+            x = x * self.mask
+
+        packed = pack_padded_sequence(x, lengths, batch_first=True)
+        if len(self.rnns) == 1: 
+            output, hidden_state = self.rnns[0](packed, hidden_state)
+            data = output.data
+            if dropout: 
+                data = data * pack_padded_sequence(self.mask.expand(-1, seq_len, -1), lengths, 
+                                                   batch_first=True).data
+            return PackedSequence(data, output.batch_sizes), hidden_state
+
+        # same chaining of layers as in `step`, on a batch that shrinks as sentences end. 
+        # (sentences are sorted by length, so the active ones are always the first n rows)
+        outputs, start = [], 0
+        for n in packed.batch_sizes.tolist(): 
+            output = packed.data[start:start + n].unsqueeze(1)
+            start += n
+            hidden_n = None if hidden_state is None else slice_hidden(hidden_state, 0, n)
+            for rnn in self.rnns: 
+                output, hidden_n = rnn(output, hidden_n)
+                if dropout: output = output * self.mask[:n]
+            
+            hidden_state = hidden_n if n == bs or hidden_state is None else \
+                           cat_hidden(hidden_n, slice_hidden(hidden_state, n, bs))
+            outputs += [output.squeeze(1)]
+
+        return PackedSequence(torch.cat(outputs, dim=0), packed.batch_sizes), hidden_state
+
+
+def slice_hidden(hidden_state, start, end): 
+    # rows [start:end] of a GRU / LSTM hidden state (num_layers x bs x h)
+    if isinstance(hidden_state, tuple): 
+        return tuple(h[:, start:end] for h in hidden_state)
+    return hidden_state[:, start:end]
+
+
+def cat_hidden(*hidden_states):
+    if isinstance(hidden_states[0], tuple): 
+        return tuple(torch.cat(hs, dim=1) for hs in zip(*hidden_states))
+    return torch.cat(hidden_states, dim=1)
+
+
+def select_hidden(hidden_state, index):
+    # rows `index` (LongTensor) of a GRU / LSTM hidden state, e.g. to reorder beams
+    if isinstance(hidden_state, tuple): 
+        return tuple(h.index_select(1, index) for h in hidden_state)
+    return hidden_state.index_select(1, index)
+
+
+class PrefixStateCache(object):
+    ''' LRU cache of the hidden states reached by a model after reading the first n words of a batch 
+        of prefixes, keyed by (model name, batch key, n). A state is computed from the longest cached 
+        one of the same batch, so a sweep over several breakpoints reads every prefix word once. 
+        The tensors held by the cache are bounded by `max_bytes` '''
+    def __init__(self, max_bytes=1 << 30):
+        self.max_bytes = max_bytes
+        self.states = OrderedDict()
+        self.num_bytes = 0
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def _size(hidden_state):
+        hs = hidden_state if isinstance(hidden_state, tuple) else (hidden_state,)
+        return sum(h.numel() * h.element_size() for h in hs)
+
+    def _put(self, key, hidden_state):
+        self.states[key] = hidden_state
+        self.num_bytes += self._size(hidden_state)
+        while self.num_bytes > self.max_bytes and len(self.states) > 1: 
+            _, evicted = self.states.popitem(last=False)
+            self.num_bytes -= self._size(evicted)
+
+    def encode(self, name, model, words, n, key):
+        ''' hidden state of `model` after reading words[:, :n] (see `Generator.encode`) '''
+        if n == 0: 
+            return None
+
+        cached = [m for (name_, key_, m) in self.states if name_ == name and key_ == key and m <= n]
+        start = max(cached) if cached else 0
+        hidden_state = self.states[(name, key, start)] if start > 0 else None
+        if start == n: 
+            self.hits += 1
+            self.states.move_to_end((name, key, n))
+            return hidden_state
+
+        self.misses += 1
+        if start > 0: 
+            self.states.move_to_end((name, key, start))
+        hidden_state = model.encode(words[:, start:n], hidden_state)
+        self._put((name, key, n), hidden_state)
+        return hidden_state
+
+
+class AdaptiveSoftmax(nn.Module):
+    ''' adaptive softmax (Grave et al., 2017) output layer. Words are sorted by frequency : the 
+        `cutoffs[0]` most frequent ones are in the head, with one extra head entry for every tail 
+        cluster. Tail clusters get a smaller projection (divided by `div_value` for every cluster). 
+        Calling the module returns exact log-probs (in word id order), which can be used as logits. 
+        `nll` only evaluates the tail clusters of the target words '''
+    def __init__(self, in_size, vocab_size, cutoffs, counts=None, div_value=4.):
+        super(AdaptiveSoftmax, self).__init__()
+        self.cutoffs = [c for c in sorted(cutoffs) if 0 < c < vocab_size] + [vocab_size]
+        self.head = nn.Linear(in_size, self.cutoffs[0] + len(self.cutoffs) - 1)
+
+        tails = []
+        for i in range(len(self.cutoffs) - 1):
+            proj_size = max(1, int(in_size // (div_value ** (i + 1))))
+            tails += [nn.Sequential(nn.Linear(in_size, proj_size, bias=False), 
+                                    nn.Linear(proj_size, self.cutoffs[i+1] - self.cutoffs[i], bias=False))]
+        self.tails = nn.ModuleList(tails)
+
+        # rank[word id] = position in the frequency sorted vocabulary. (when loading a saved 
+        # model, counts are not needed : the buffer is restored from the state dict)
+        counts = np.ones(vocab_size) if counts is None else np.asarray(counts)
+        order = torch.from_numpy(np.argsort(-counts, kind='mergesort'))
+        rank = torch.zeros_like(order)
+        rank[order] = torch.arange(vocab_size).long()
+        self.register_buffer('rank', rank)
+
+    def log_prob(self, x):
+        # x : N x in_size --> N x vocab_size log-probs, in frequency order
+        head = F.log_softmax(self.head(x), dim=1)
+        log_probs = [head[:, :self.cutoffs[0]]]
+        for i, tail in enumerate(self.tails): 
+            log_probs += [head[:, [self.cutoffs[0] + i]] + F.log_softmax(tail(x), dim=1)]
+        return torch.cat(log_probs, dim=1)
+
+    def forward(self, x):
+        log_probs = self.log_prob(x.reshape(-1, x.size(-1))).index_select(1, self.rank)
+        return log_probs.view(*(x.shape[:-1] + (-1,)))
+
+    def nll(self, x, target):
+        # x : ... x in_size, target : ...  --> nll of every target word, same shape as target
+        x, rank = x.reshape(-1, x.size(-1)), self.rank[target.reshape(-1)]
+        cluster = torch.zeros_like(rank) # 0 for the head
+        for c in self.cutoffs[:-1]: 
+            cluster += (rank >= c).long()
+
+        head = F.log_softmax(self.head(x), dim=1)
+        head_idx = torch.where(cluster == 0, rank, self.cutoffs[0] + cluster - 1)
+        log_prob = head.gather(1, head_idx.unsqueeze(1)).squeeze(1)
+
+        for i, tail in enumerate(self.tails): 
+            rows = (cluster == i + 1).nonzero().squeeze(1)
+            if rows.numel() == 0: continue
+            tail_log_probs = F.log_softmax(tail(x[rows]), dim=1)
+            in_tail = (rank[rows] - self.cutoffs[i]).unsqueeze(1)
+            log_prob = log_prob.index_add(0, rows, tail_log_probs.gather(1, in_tail).squeeze(1))
+
+        return -log_prob.view(target.shape)
+
+
+def sampled_softmax_nll(x, target, output_layer, sample_probs, num_sampled):
+    ''' training-time approximation of the nll under the dense `output_layer` : the softmax is 
+        taken over the target and `num_sampled` negative words (shared across the batch) drawn 
+        from `sample_probs`, with the usual log Q correction '''
+    x, target = x.reshape(-1, x.size(-1)), target.reshape(-1)
+    negatives = torch.multinomial(sample_probs, num_sampled, replacement=True)
+    log_q = torch.log(sample_probs * num_sampled)
+
+    weight, bias = output_layer.weight, output_layer.bias
+    true_logits = (x * weight[target]).sum(1) + bias[target] - log_q[target]
+    neg_logits  = x.matmul(weight[negatives].t()) + bias[negatives] - log_q[negatives]
+
+    # a negative equal to the target should not be counted against it
+    neg_logits = neg_logits.masked_fill(negatives.unsqueeze(0) == target.unsqueeze(1), -float('inf'))
+    logits = torch.cat([true_logits.unsqueeze(1), neg_logits], dim=1)
+    return -F.log_softmax(logits, dim=1)[:, 0].view(target.shape)
+
+
+class DecodingStrategy(object):
+    ''' turns the (temperature scaled) logits of a timestep (bs x vocab_size) into sampled words. 
+        top_k     : only sample among the k most likely words (0 : no limit)
+        top_p     : nucleus sampling, among the most likely words with a total mass >= top_p
+        typical_p : locally typical sampling, among the words whose -log p is the closest to the 
+                    entropy, with a total mass >= typical_p
+        Candidates are fetched with a batched `topk` instead of sorting the vocab. For top_p and 
+        typical_p, the number of candidates is doubled until it covers the required mass for every 
+        row, and kept for the next timesteps '''
+    def __init__(self, top_k=0, top_p=1., typical_p=1., num_candidates=64):
+        assert not (top_p < 1. and typical_p < 1.), 'top_p and typical_p are exclusive'
+        self.top_k = top_k
+        self.top_p = top_p
+        self.typical_p = typical_p
+        self.num_candidates = num_candidates
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(top_k=getattr(args, 'top_k', 0), top_p=getattr(args, 'top_p', 1.), 
+                   typical_p=getattr(args, 'typical_p', 1.))
+
+    def is_plain(self):
+        # sampling from the full distribution
+        return self.top_k == 0 and self.top_p >= 1. and self.typical_p >= 1.
+
+    def candidates(self, logits):
+        ''' returns the log-probs of the candidate words (-inf for the filtered ones) and their ids, 
+            both bs x k '''
+        log_probs = F.log_softmax(logits, dim=-1)
+        vocab_size = logits.size(-1)
+        max_k = min(self.top_k or vocab_size, vocab_size)
+
+        if self.typical_p < 1.: 
+            entropy = -(log_probs.exp() * log_probs).sum(dim=-1, keepdim=True)
+            scores, mass = -(log_probs + entropy).abs(), self.typical_p
+        else: 
+            scores, mass = log_probs, self.top_p
+
+        if mass >= 1.: 
+            ids = scores.topk(max_k, dim=-1)[1]
+            return log_probs.gather(-1, ids), ids
+
+        while True: 
+            k = min(self.num_candidates, max_k)
+            ids = scores.topk(k, dim=-1)[1]
+            cand_log_probs = log_probs.gather(-1, ids)
+            cum_probs = cand_log_probs.exp().cumsum(dim=-1)
+            if k == max_k or bool((cum_probs[:, -1] >= mass).all()): 
+                break
+            self.num_candidates *= 2
+
+        # keep a word if the mass of the words before it is below the threshold (the first one always is)
+        drop = (cum_probs - cand_log_probs.exp()) >= mass
+        return cand_log_probs.masked_fill(drop, -float('inf')), ids
+
+    def __call__(self, logits):
+        if self.is_plain(): 
+            return Categorical(logits=logits).sample()
+
+        cand_log_probs, ids = self.candidates(logits)
+        choice = Categorical(logits=cand_log_probs).sample()
+        return ids.gather(1, choice.unsqueeze(1)).squeeze(1)
+
 
 class Generator(Model):
-    def __init__(self, args, is_oracle=False):
+    def __init__(self, args, is_oracle=False, counts=None):
+        ''' counts : training set frequency of every word (see `word_counts`). Only used by the 
+                     adaptive and sampled output layers '''
         super(Generator, self).__init__(args.num_layers_gen, args.hidden_dim_gen, args)
         
         in_size = args.hidden_dim_gen
         if args.leak_info: 
             in_size += args.hidden_dim_disc
 
-        self.output_layer = nn.Linear(in_size, args.vocab_size)
+        self.output_type = getattr(args, 'output_layer', 'dense')
+        if self.output_type == 'adaptive': 
+            self.output_layer = AdaptiveSoftmax(in_size, args.vocab_size, args.adaptive_cutoffs, counts)
+        else: 
+            self.output_layer = nn.Linear(in_size, args.vocab_size)
+
+        if self.output_type == 'sampled': 
+            # negatives are drawn from the unigram distribution, smoothed as in word2vec
+            probs = np.ones(args.vocab_size) if counts is None else np.asarray(counts, dtype=np.float64)
+            probs = torch.from_numpy(probs ** 0.75).float()
+            self.register_buffer('sample_probs', probs / probs.sum())
+
         self.is_oracle = is_oracle
+        self.decoding = DecodingStrategy() # plain sampling, see `DecodingStrategy`
+
+    def get_alpha(self, alpha=None):
+        if alpha is not None: 
+            return alpha
+        return self.args.alpha_train if self.training  else self.args.alpha_test
 
-    def forward(self, x, hidden_state=None, disc=None):
+    def forward(self, x, hidden_state=None, disc=None, alpha=None, lengths=None):
         assert len(x.size()) == 2 # bs x seq_len
-        ''' note that x[:, 0] is always SOS token'''
+        ''' note that x[:, 0] is always SOS token. 
+            With `lengths` (teacher forcing only), <pad> positions are skipped and the logits are 
+            returned as a PackedSequence '''
 
         # if only one word is given, use it as starting token, than sample from your distribution 
-        teacher_force  = x.size(1) != 1
-        seq_len        = x.size(1) if teacher_force else self.args.max_seq_len
-        input_idx      = x[:, [0]]
-        outputs, words = [], []
+        teacher_force = x.size(1) != 1
+        if not teacher_force: 
+            return self.sample(x, hidden_state=hidden_state, disc=disc, alpha=alpha)
+
+        output = self.features(x, hidden_state=hidden_state, disc=disc, lengths=lengths)
+        packed = isinstance(output, PackedSequence)
+        if packed: 
+            output, batch_sizes = output.data, output.batch_sizes
+
+        logits = self.output_layer(output)
+        if not self.is_oracle: 
+            logits = logits * self.get_alpha(alpha)
+
+        if packed: 
+            logits = PackedSequence(logits, batch_sizes)
+
+        return logits, []
+
+    def features(self, x, hidden_state=None, disc=None, lengths=None):
+        ''' teacher forced inputs of the output layer (a PackedSequence if `lengths` is given) '''
+        # the whole sequence is known in advance : no need to go one timestep at a time
+        input = self.embedding(x)
+        output, hidden_state = self.run(input, hidden_state, \
+                var_drop_p=self.args.var_dropout_p_gen, lengths=lengths)
+
+        if self.args.leak_info:
+            assert disc is not None
+            output_disc, _ = disc.run(input, None, var_drop_p=self.args.var_dropout_p_disc, \
+                    lengths=lengths)
+            if isinstance(output, PackedSequence): 
+                return PackedSequence(torch.cat([output.data, output_disc.data], dim=-1), output.batch_sizes)
+            output = torch.cat([output, output_disc], dim=-1)
+
+        return output
+
+    def mle_loss(self, x, target, lengths, disc=None):
+        ''' teacher forced nll of `target`, averaged over valid tokens. The adaptive output layer (and 
+            the sampled one, in training mode) never compute the full vocab_size logits '''
+        cheap_nll = self.output_type == 'adaptive' or (self.output_type == 'sampled' and self.training)
+        if not cheap_nll or (not self.is_oracle and self.get_alpha() != 1.): 
+            logits, _ = self(x, disc=disc, lengths=lengths)
+            return masked_cross_entropy(logits, target, lengths)
+
+        output = self.features(x, disc=disc, lengths=lengths).data
+        target = pack_padded_sequence(target, lengths.tolist(), batch_first=True).data
+        if self.output_type == 'adaptive': 
+            nll = self.output_layer.nll(output, target)
+        else: 
+            nll = sampled_softmax_nll(output, target, self.output_layer, self.sample_probs, 
+                                      self.args.num_sampled)
+
+        return nll.sum() / lengths.float().sum()
+
+    def sample(self, x, hidden_state=None, disc=None, seq_len=None, alpha=None, keep_logits=True, 
+               stop_at_eos=False, decoding=None):
+        ''' free running generation from the starting tokens x (bs x 1). 
+            alpha       : overrides the model's temperature. Can also be a bs x 1 x 1 tensor
+            keep_logits : also return the bs x seq_len x vocab_size logits (needed for training)
+            stop_at_eos : rows are padded after their first <eos> / <pad>, and generation stops 
+                          once every row is done. Only for real data, where these tokens exist 
+            decoding    : overrides `self.decoding` (logits --> words) '''
+        assert x.size(1) == 1
+        assert not (keep_logits and stop_at_eos), 'logits would be truncated'
+        seq_len   = seq_len or self.args.max_seq_len
+        alpha     = self.get_alpha(alpha)
+        input_idx = x
+        words     = x.data.new(x.size(0), seq_len).fill_(PAD_token)
+        logits, done = [], None
 
         if self.args.leak_info:
             assert disc is not None
             hidden_state_disc = None
 
         for t in range(seq_len):
-            # choose first token, or overwrite sampled one
-            if teacher_force or t == 0: 
-                input_idx = x[:, [t]]
-
             input = self.embedding(input_idx)
             output, hidden_state = self.step(input, hidden_state, t, \
                     var_drop_p=self.args.var_dropout_p_gen)
@@ -81,23 +435,141 @@ class Generator(Model):
                 output = torch.cat([output, output_disc], dim=-1)
 
             dist = self.output_layer(output)
-            alpha = self.args.alpha_train if self.training  else self.args.alpha_test
             if not self.is_oracle: 
                 dist = dist * alpha
    
-            if not teacher_force:
-                input_idx = Categorical(logits=dist.squeeze(1)).sample().unsqueeze(1)
-                words += [input_idx]
+            input_idx = (decoding or self.decoding)(dist.squeeze(1)).unsqueeze(1)
+            
+            if stop_at_eos: 
+                if done is not None: 
+                    input_idx = input_idx.masked_fill(done, PAD_token)
+                is_done = (input_idx == EOS_token) | (input_idx == PAD_token)
+                done = is_done if done is None else done | is_done
+
+            words[:, t] = input_idx.squeeze(1)
 
             # note : these are 1-off with input, or aligned with target
-            outputs += [dist] 
-        
-        if not teacher_force : 
-            words = torch.cat(words, dim=1)
+            if keep_logits: 
+                logits += [dist] 
+
+            if stop_at_eos and done.all(): 
+                break
         
-        logits = torch.cat(outputs, dim=1)
+        logits = torch.cat(logits, dim=1) if keep_logits else None
         return logits, words
 
+    def encode(self, prefix, hidden_state=None):
+        ''' hidden state after reading `prefix` (bs x t) in teacher forcing mode. `sample`, `greedy` 
+            and `beam_search` can resume from it, given the next word '''
+        assert not self.args.leak_info, 'the discriminator state is not tracked'
+        _, hidden_state = self.run(self.embedding(prefix), hidden_state, \
+                var_drop_p=self.args.var_dropout_p_gen)
+        return hidden_state
+
+    def greedy(self, x, hidden_state=None, seq_len=None, stop_at_eos=True):
+        ''' most likely word at every step, from the starting tokens x (bs x 1) '''
+        return self.sample(x, hidden_state=hidden_state, seq_len=seq_len, keep_logits=False, 
+                           stop_at_eos=stop_at_eos, decoding=lambda logits: logits.argmax(dim=-1))[1]
+
+    def beam_search(self, x, hidden_state=None, beam_size=5, seq_len=None, length_penalty=1., 
+                    stop_at_eos=True, max_batch_size=None):
+        ''' batched beam search from the starting tokens x (bs x 1). The bs * beam_size beams are kept 
+            in a flat batch, and hidden states are reordered with `index_select`. 
+            length_penalty : final scores are log p / length ** length_penalty (0 : no normalization)
+            stop_at_eos    : beams end at their first <eos>, and decoding stops once all of them did
+            max_batch_size : starting tokens are processed in chunks of this size, to bound memory 
+            returns the best beam (bs x seq_len, padded) and its normalized score (bs) '''
+        assert x.size(1) == 1
+        assert not self.args.leak_info, 'the discriminator state is not tracked'
+        chunk = max_batch_size or x.size(0)
+        if x.size(0) > chunk: 
+            outs = [self.beam_search(x[i:i+chunk], None if hidden_state is None else \
+                        slice_hidden(hidden_state, i, i + chunk), beam_size, seq_len, length_penalty, 
+                        stop_at_eos) for i in range(0, x.size(0), chunk)]
+            return torch.cat([w for (w, _) in outs], dim=0), torch.cat([s for (_, s) in outs], dim=0)
+
+        bs, beam = x.size(0), beam_size
+        seq_len = seq_len or self.args.max_seq_len
+        alpha   = self.get_alpha()
+
+        # every row is repeated beam_size times (beams of a sentence are contiguous)
+        rows = torch.arange(bs, device=x.device).unsqueeze(1).expand(bs, beam).reshape(-1)
+        input_idx = x.index_select(0, rows)
+        if hidden_state is not None: 
+            hidden_state = select_hidden(hidden_state, rows)
+
+        # only the first beam is alive at first, so that beams don't all pick the same word
+        scores = x.new_zeros(bs, beam).float()
+        scores[:, 1:] = -float('inf')
+        words    = x.new(bs * beam, seq_len).fill_(PAD_token)
+        lengths  = x.new_zeros(bs * beam)
+        finished = torch.zeros(bs * beam, dtype=torch.bool, device=x.device)
+        offsets  = (torch.arange(bs, device=x.device) * beam).unsqueeze(1)
+
+        for t in range(seq_len):
+            output, hidden_state = self.step(self.embedding(input_idx), hidden_state, t, \
+                    var_drop_p=self.args.var_dropout_p_gen)
+            dist = self.output_layer(output).squeeze(1)
+            if not self.is_oracle: 
+                dist = dist * alpha
+            log_probs = F.log_softmax(dist, dim=-1)
+            vocab_size = log_probs.size(-1)
+
+            if stop_at_eos: 
+                # finished beams can only be extended with <pad>, at no cost
+                log_probs = log_probs.masked_fill(finished.unsqueeze(1), -float('inf'))
+                log_probs[:, PAD_token].masked_fill_(finished, 0.)
+
+            candidates = (scores.view(-1, 1) + log_probs).view(bs, beam * vocab_size)
+            scores, best = candidates.topk(beam, dim=1)
+            word = best % vocab_size
+            src  = (offsets + best // vocab_size).view(-1)
+
+            # reorder everything along the flat beam axis
+            hidden_state = select_hidden(hidden_state, src)
+            words, lengths, finished = words.index_select(0, src), lengths.index_select(0, src), \
+                                       finished.index_select(0, src)
+            word = word.view(-1)
+            words[:, t] = word
+            lengths += (~finished).long()
+            if stop_at_eos: 
+                finished = finished | (word == EOS_token) | (word == PAD_token)
+                if bool(finished.all()): 
+                    break
+
+            input_idx = word.unsqueeze(1)
+
+        norm_scores = scores / lengths.view(bs, beam).float().clamp(min=1) ** length_penalty
+        norm_scores, best_beam = norm_scores.max(dim=1)
+        best = (offsets.squeeze(1) + best_beam)
+        return words.index_select(0, best), norm_scores
+
+    def temperature_logits(self, x, alphas, disc=None):
+        ''' teacher forced logits for every alpha in `alphas`, yielded as (alpha, logits) pairs. 
+            Hidden states do not depend on alpha, so a single forward pass is needed '''
+        assert x.size(1) != 1
+        logits = self(x, disc=disc, alpha=1.)[0]
+        for alpha in alphas: 
+            yield alpha, logits * alpha
+
+    def temperature_samples(self, x, alphas, disc=None, seq_len=None, max_batch_size=None):
+        ''' free running samples for every alpha in `alphas`, returned as a list (one bs x seq_len 
+            tensor per alpha). All alphas are sampled in the same len(alphas) * bs batch, which can 
+            be split in chunks of `max_batch_size` rows to bound memory '''
+        assert x.size(1) == 1
+        bs, n_alphas = x.size(0), len(alphas)
+        alpha = torch.tensor([float(a) for a in alphas], device=x.device)
+        alpha = alpha.view(-1, 1, 1, 1).expand(-1, bs, 1, 1).reshape(-1, 1, 1)
+        x = x.repeat(n_alphas, 1)
+
+        chunk, words = max_batch_size or x.size(0), []
+        for i in range(0, x.size(0), chunk):
+            words += [self.sample(x[i:i+chunk], disc=disc, seq_len=seq_len, alpha=alpha[i:i+chunk], 
+                                  keep_logits=False)[1]]
+
+        words = torch.cat(words, dim=0)
+        return list(words.view(n_alphas, bs, -1))
+
 
 class Discriminator(Model):
     def __init__(self, args):
@@ -105,19 +577,18 @@ class Discriminator(Model):
         self.output_layer = nn.Linear(args.hidden_dim_disc, 1)
         self.critic       = nn.Linear(args.hidden_dim_disc, 1)
     
-    def forward(self, x, hidden_state=None):
+    def forward(self, x, hidden_state=None, lengths=None):
         assert len(x.size()) == 2 # bs x seq_len
-        ''' note that x[:, 0] is NOT SOS token, but the first word of sentence '''
+        ''' note that x[:, 0] is NOT SOS token, but the first word of sentence. 
+            With `lengths`, the rnn skips <pad> positions (outputs there are computed from zeros) '''
 
         baseline = torch.ones_like(x[:, [0]]).float() * np.log(0.5)
 
         emb = self.embedding(x)
-        outputs  = []
-        for t in range(emb.size(1)):
-            output, hidden_state = self.step(emb[:, [t]], hidden_state, t, var_drop_p=self.args.var_dropout_p_disc)
-            outputs += [output]
-
-        output = torch.cat(outputs, dim=1)
+        output, hidden_state = self.run(emb, hidden_state, var_drop_p=self.args.var_dropout_p_disc, 
+                                        lengths=lengths)
+        if lengths is not None: 
+            output = pad_packed_sequence(output, batch_first=True, total_length=x.size(1))[0]
         disc_logits = self.output_layer(output).squeeze(-1)
         baseline_ = self.critic(output.detach()).squeeze(-1) # critic gradient should not flow
         baseline = torch.cat([baseline, baseline_], dim=1)[:, :-1]
@@ -256,3 +727,33 @@ class ConvNetSelfAttn(nn.Module):
         out = out.max(dim=2)[0] # max over sequence axis
         
         return self.out(out)
+
+
+if __name__ == '__main__':
+    # `run` must match calling `step` on every timestep (same dropout mask, with the same seed)
+    from argparse import Namespace
+    bs, seq_len, hidden_dim = 8, 12, 16
+    for rnn_type in ['LSTM', 'GRU']:
+        for num_layers in [1, 2]:
+            model = Model(num_layers, hidden_dim, Namespace(vocab_size=10, rnn=rnn_type))
+            x = torch.randn(bs, seq_len, hidden_dim)
+            for training in [False, True]:
+                model.train(training)
+                with torch.no_grad():
+                    torch.manual_seed(0)
+                    out_run, hidden_run = model.run(x, var_drop_p=0.5)
+
+                    torch.manual_seed(0)
+                    outs, hidden_step = [], None
+                    for t in range(seq_len):
+                        out, hidden_step = model.step(x[:, [t]], hidden_step, t, var_drop_p=0.5)
+                        outs += [out]
+                    out_step = torch.cat(outs, dim=1)
+
+                hidden_run  = hidden_run  if isinstance(hidden_run,  tuple) else (hidden_run,)
+                hidden_step = hidden_step if isinstance(hidden_step, tuple) else (hidden_step,)
+                assert torch.allclose(out_run, out_step, atol=1e-6), (rnn_type, num_layers, training)
+                for h_run, h_step in zip(hidden_run, hidden_step):
+                    assert torch.allclose(h_run, h_step, atol=1e-6), (rnn_type, num_layers, training)
+                print('{} {} layer(s), {:<5} : run == step'.format(
+                    rnn_type, num_layers, 'train' if training else 'eval'))
@@ -1,10 +1,17 @@
 from __future__ import division
+import atexit
+import contextlib
+import copy
 import pdb
+import queue
 import random
 import os
+import threading
 import time
 import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torch.nn as nn
 from torch.autograd import Variable
 from torch.nn import functional as F
@@ -12,67 +19,69 @@ from torch.nn import functional as F
 from data import * 
 from args import * 
 
-def minibatch_generator(dataset, args, shuffle=True):
+BUCKET_POOL_SIZE = 50 # in batches, see `minibatch_generator`
+WORLD_SIZE = 1        # data parallel processes, see `init_distributed`
+RANK = 0
+
+def minibatch_generator(dataset, args, shuffle=True, bucket=False, stats=None, cuda=None, shard=None):
     """
-    Generator used to feed the minibatches
+    Generator used to feed the minibatches. 
+    bucket : (padded mode only) batches hold sentences of similar length. With args.mask_padding, 
+             every batch is also only padded up to its longest sentence
+    stats  : optional dict, in which the number of words and of (padded) tokens is accumulated
+    cuda   : overrides args.cuda (e.g. batches are moved to the gpu by a `Prefetcher` instead)
+    shard  : (rank, world_size). Only yields batches rank, rank + world_size, ... and drops the 
+             last batches that can't be split evenly, so that every process takes as many steps. 
+             The python / numpy RNGs must be seeded identically in every process
     """
-    PAD_token = 0
-    SOS_token = 2
-    total_words = sum([len(x) for x in dataset])
-
+    cuda = args.cuda if cuda is None else cuda
+    rank, world_size = (0, 1) if shard is None else shard
     if args.stream_data:
-        # ASSUMES the given dataset is an ORDERED sequence of sentences. 
+        # ASSUMES the given dataset is an ORDERED sequence of sentences. Every row is a window of 
+        # max_seq_len + 1 contiguous words, starting at a sentence and running over the next ones
 
         if args.max_seq_len is None: 
             raise ValueError('a sentence length parameter (max_seq_len) is required when data is streamed')
 
-        # TODO: don't hardcode the 10k
-        words_per_minibatch = args.batch_size * (args.max_seq_len + 1)
+        window = args.max_seq_len + 1
+        total_words = len(dataset.tokens)
+        words_per_minibatch = args.batch_size * window
         num_batches = max(1, total_words // words_per_minibatch)
     
         # we need to calculate what is the last sentence index we can reach; for example, 
         # if our dataset has sentences of length 20, and max_seq_len == 100, then we can't 
         # start a minibatch pt with the last 4 sentences, as we would run out of words. 
-        last_available_sentence = len(dataset) 
-        words_needed = args.max_seq_len
-        while words_needed > 0: 
-            last_available_sentence -= 1
-            assert last_available_sentence >= 0, 'not enough data to generate a single sentence!'
-            words_needed -= len(dataset[last_available_sentence])
-
-        current_batch = 0
-        sentence_index = 0
-        while current_batch < num_batches: 
-            current_batch += 1
-            batch = []
-            while len(batch) < args.batch_size:
-                if shuffle: 
-                    ind = np.random.randint(last_available_sentence + 1)
-                else: 
-                    ind = sentence_index % (last_available_sentence + 1)
-                    sentence_index += 1
+        last_available_sentence = np.searchsorted(dataset.offsets[:-1], total_words - window, 
+                                                  side='right') - 1
+        assert last_available_sentence >= 0, 'not enough data to generate a single sentence!'
+
+        # every window of the corpus, as a strided view of the token array (nothing is copied)
+        itemsize = dataset.tokens.itemsize
+        windows = np.lib.stride_tricks.as_strided(dataset.tokens, shape=(total_words - window + 1, window), 
+                                                  strides=(itemsize, itemsize), writeable=False)
 
-                # now, we fetch the correct amt of words from the sentence `ind` points to. 
-                current_sentence = []
-                while len(current_sentence) != args.max_seq_len + 1: 
-                    indexed_sentence = dataset[ind]
-                    words_taken = min(args.max_seq_len + 1 - len(current_sentence), \
-                                      len(indexed_sentence))
+        sentence_index = 0
+        for b in range(num_batches): 
+            if shuffle: 
+                sentences = np.random.randint(last_available_sentence + 1, size=args.batch_size)
+            else: 
+                sentences = (sentence_index + np.arange(args.batch_size)) % (last_available_sentence + 1)
+                sentence_index += args.batch_size
 
-                    current_sentence += indexed_sentence[:words_taken]
+            # (the RNG is still consumed for the other processes' batches)
+            if b % world_size != rank or b >= num_batches // world_size * world_size: 
+                continue
 
-                batch += [current_sentence]
-            
-            batch_src = torch.LongTensor(batch).view(args.batch_size, args.max_seq_len + 1)
+            batch_src = torch.from_numpy(windows[dataset.offsets[sentences]].astype(np.int64))
             input  = batch_src[:, :-1]
             target = batch_src[:, 1:]
-            len_s  = [args.max_seq_len] * args.batch_size
-            len_s  = torch.LongTensor(len_s)
-
-            input  = Variable(input)
-            target = Variable(target)
+            len_s  = torch.LongTensor(args.batch_size).fill_(args.max_seq_len)
+            if stats is not None: 
+                # windows are never padded
+                stats['tokens'] = stats.get('tokens', 0) + args.batch_size * args.max_seq_len
+                stats['words']  = stats.get('words', 0)  + args.batch_size * args.max_seq_len
             
-            if args.cuda:
+            if cuda:
                 input = input.cuda()
                 target = target.cuda()
                 len_s = len_s.cuda()
@@ -80,75 +89,362 @@ def minibatch_generator(dataset, args, shuffle=True):
             yield input, target, len_s 
             
     else: 
-        def fill_seq(input, padded_length, fill_token):
-            input_padded = input[:]
-            input_padded += [fill_token] * (padded_length - len(input))
-            return input_padded
-
         nb_elem = len(dataset)
         indices = list(range(nb_elem))
         if shuffle:
             random.shuffle(indices)
 
-        while nb_elem > 0:
+        # sentences are consumed from the end of `indices`
+        indices = np.array(indices[::-1], dtype=np.int64)
+
+        if bucket: 
+            # sort sentences by length inside pools of BUCKET_POOL_SIZE batches, so that every 
+            # batch holds sentences of similar length, and shuffle the order of the batches
+            pool_size = args.batch_size * BUCKET_POOL_SIZE
+            for start in range(0, nb_elem, pool_size):
+                pool = indices[start:start + pool_size]
+                indices[start:start + pool_size] = pool[np.argsort(dataset.lengths[pool], kind='mergesort')]
+
+        batches = [indices[start:start + args.batch_size] for start in range(0, nb_elem, args.batch_size)]
+        if bucket and shuffle: 
+            random.shuffle(batches)
+        batches = batches[:len(batches) // world_size * world_size][rank::world_size]
+
+        for batch in batches:
+            input, target, len_s = build_padded_batch(dataset, batch, args, trim=bucket, cuda=cuda)
+            if stats is not None: 
+                seq_len = target.size(1)
+                stats['tokens'] = stats.get('tokens', 0) + len(batch) * seq_len
+                stats['words']  = stats.get('words', 0)  + int(np.minimum(dataset.lengths[batch], seq_len).sum())
 
-            b_, len_ = [], []
-
-            count = 0
-            while count < args.batch_size and nb_elem > 0:
-                ind = indices.pop()
-                count += 1
-                nb_elem -= 1
-
-                b_.append(dataset[ind])
-                len_.append(len(dataset[ind]))
-            
-            max_ = args.max_seq_len if args.max_seq_len is not None else max(len_)
-            if args.mask_padding: 
-                len_ = [ min(x, max_) for x in len_]
-            else: 
-                len_ = [max_ for _ in len_]
+            yield input, target, len_s
+        
 
-            b_   = [sentence[:max_] for sentence in b_]    
+def padding_ratio(stats):
+    # fraction of the minibatch tokens that are <pad>, from `minibatch_generator` stats. 
+    # None if no batch was seen
+    if stats.get('tokens', 0) == 0: return None
+    return 1. - stats['words'] / stats['tokens']
 
-            # we need to fill shorter sentences to make tensor
-            b__ = [fill_seq(seq, max_, PAD_token) for seq in b_]
 
-            # sort the lists by len_src for pack_padded_sentence later
-            b_sorted = [(x,l) for (x,l) in \
-                           sorted(zip(b__, len_),
-                                  key=lambda v: v[1],  # using len_src
-                                  reverse=True)]  # descending order
+def build_padded_batch(dataset, indices, args, trim=False, cuda=None):
+    """
+    Gathers and pads the sentences `indices` of `dataset` (a `Corpus`) in a few numpy ops. 
+    With `trim` (and args.mask_padding), the batch is only padded up to its longest sentence
+    """
+    lengths = dataset.lengths[indices]
+    max_ = args.max_seq_len if args.max_seq_len is not None else int(lengths.max())
+    if trim and args.mask_padding: 
+        max_ = min(max_, int(lengths.max()))
+    lengths = np.minimum(lengths, max_)
+    len_s = lengths if args.mask_padding else np.full_like(lengths, max_)
+
+    # sort by len_s (descending, stable) for pack_padded_sentence later
+    order = np.argsort(-len_s, kind='mergesort')
+    indices, lengths, len_s = indices[order], lengths[order], len_s[order]
+
+    # fetch every (truncated) sentence at once, and fill shorter ones with PAD_token
+    positions = np.arange(max_)
+    is_word = positions[None, :] < lengths[:, None]
+    word_idx = np.where(is_word, dataset.offsets[indices][:, None] + positions[None, :], 0)
+    batch_src = np.where(is_word, dataset.tokens[word_idx], PAD_token).astype(np.int64)
+
+    # create the target
+    target = batch_src
+    input = np.empty_like(target)
+    input[:, 0] = SOS_token
+    input[:, 1:] = target[:, :-1]
+
+    input  = torch.from_numpy(input)
+    target = torch.from_numpy(target)
+    len_s  = torch.from_numpy(len_s.astype(np.int64))
+
+    if (args.cuda if cuda is None else cuda):
+        input = input.cuda()
+        target = target.cuda()
+        len_s = len_s.cuda()
+
+    return input, target, len_s
+
+
+class Prefetcher(object):
+    """
+    Iterates over the (cpu) batches of `loader`, e.g. a `minibatch_generator`. With depth > 0, a 
+    background thread builds the next `depth` batches while the current step runs. With pin_memory, 
+    they are copied in a ring of preallocated pinned buffers, and sent asynchronously to the gpu 
+    (otherwise the loader's batches are handed over as they are, as they are already fresh tensors).
+    `stall_time` keeps track of how long the training loop waited for data. 
+    `close` stops the background thread (e.g. when the loop exits before the end of the data)
+    """
+    def __init__(self, loader, depth=2, cuda=False, pin_memory=False):
+        self.loader = iter(loader)
+        self.depth = depth
+        self.cuda = cuda
+        self.pin_memory = pin_memory and cuda
+        self.exhausted = False
+        self.stall_time, self.num_batches = 0., 0
+        self.start_time = time.time()
+
+        if depth > 0: 
+            # (pinned) a slot can be in the queue, be filled by the worker, and be used by an 
+            # async copy to the gpu at the same time
+            self.slots  = [None] * (depth + 2)
+            self.events = [None] * (depth + 2)
+            self.free_slots = queue.Queue()
+            for i in range(depth + 2): 
+                self.free_slots.put(i)
+            self.batches = queue.Queue(maxsize=depth)
+            self.done = threading.Event()
+            self.worker = threading.Thread(target=self._fill)
+            self.worker.daemon = True
+            self.worker.start()
+
+    def _copy_to_slot(self, index, batch):
+        # (re)allocate the slot's buffers if this batch does not fit, and return views of the right shape
+        if self.events[index] is not None: 
+            # previous content of the slot might still be on its way to the gpu
+            self.events[index].synchronize()
+            self.events[index] = None
+
+        slot = self.slots[index]
+        if slot is None or any(buf.numel() < t.numel() for (buf, t) in zip(slot, batch)):
+            slot = [torch.empty(t.numel(), dtype=t.dtype) for t in batch]
+            if self.pin_memory: 
+                slot = [buf.pin_memory() for buf in slot]
+            self.slots[index] = slot
+
+        return [buf[:t.numel()].view(t.size()).copy_(t) for (buf, t) in zip(slot, batch)]
+
+    def _put(self, item):
+        while not self.done.is_set():
+            try: 
+                self.batches.put(item, timeout=0.1)
+                return True
+            except queue.Full: 
+                pass
+        return False
+
+    def _get_slot(self):
+        while not self.done.is_set():
+            try: 
+                return self.free_slots.get(timeout=0.1)
+            except queue.Empty: 
+                pass
+        return None
+
+    def _fill(self):
+        try: 
+            for batch in self.loader: 
+                if self.pin_memory: 
+                    index = self._get_slot()
+                    if index is None: 
+                        return
+                    batch = self._copy_to_slot(index, batch)
+                else: 
+                    index = None
+                if not self._put((index, batch)): 
+                    return
+            self._put(None)
+        except Exception as e: 
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.exhausted: 
+            raise StopIteration
+        t0 = time.time()
+        if self.depth == 0: 
+            batch = next(self.loader)
+            if self.cuda: 
+                batch = [t.cuda() for t in batch]
+        else: 
+            item = self.batches.get()
+            if item is None or isinstance(item, Exception): 
+                # nothing comes after these
+                self.exhausted = True
+                self.stall_time += time.time() - t0
+                if item is None: raise StopIteration
+                raise item
+
+            index, batch = item
+            if self.cuda: 
+                batch = [t.cuda(non_blocking=self.pin_memory) for t in batch]
+            if index is not None: 
+                # pinned slot : free once the async copy is done
+                self.events[index] = torch.cuda.Event()
+                self.events[index].record()
+                self.free_slots.put(index)
+
+        self.stall_time += time.time() - t0
+        self.num_batches += 1
+        return batch
+
+    def close(self):
+        self.exhausted = True
+        if self.depth > 0: 
+            self.done.set()
+
+    def stall_ratio(self):
+        # fraction of the time since creation spent waiting for data
+        return self.stall_time / max(time.time() - self.start_time, 1e-8)
+
+
+def get_loader(dataset, args, shuffle=True, **kwargs):
+    # `minibatch_generator` wrapped in a `Prefetcher`, following args.prefetch_depth / args.pin_memory
+    loader = minibatch_generator(dataset, args, shuffle=shuffle, cuda=False, **kwargs)
+    return Prefetcher(loader, depth=args.prefetch_depth, cuda=args.cuda, pin_memory=args.pin_memory)
+
+
+def word_log_prob(logits, words):
+    # log-prob of every word of `words` (bs x seq_len) under logits (bs x seq_len x vocab_size)
+    return torch.gather(F.log_softmax(logits, dim=2), 2, words.unsqueeze(2)).squeeze(2)
+
+
+def policy_log_prob(gen, start, sentences):
+    # log-prob of every word of `sentences` (bs x seq_len) under `gen`, teacher forced and without 
+    # dropout : it is the same wherever it is computed, unlike with a fresh dropout mask every time
+    training = gen.training
+    gen.eval()
+    with torch.no_grad():
+        logits, _ = gen(torch.cat([start, sentences[:, :-1]], dim=1))
+    gen.train(training)
+    return word_log_prob(logits, sentences)
+
+
+def _rollout_worker(shared_gen, version, lock, rollouts, stop, batch_size, seed):
+    # actor loop of `RolloutWorkers`
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    gen, seen = copy.deepcopy(shared_gen), -1
+    gen.train() # sample like the learner would
+    start = torch.LongTensor(batch_size, 1).fill_(SOS_token)
+
+    with torch.no_grad():
+        while not stop.is_set():
+            if version.value != seen: 
+                with lock: 
+                    gen.load_state_dict(shared_gen.state_dict())
+                    seen = version.value
+
+            _, sentences = gen.sample(start, keep_logits=False)
+            log_prob = policy_log_prob(gen, start, sentences)
+            while not stop.is_set(): 
+                try: 
+                    rollouts.put((start, sentences, log_prob, seen), timeout=1)
+                    break
+                except queue.Full: 
+                    pass
+
+
+class RolloutWorkers(object):
+    """
+    Actor / learner sampling for adversarial training. `num_workers` processes keep sampling batches 
+    of sentences (from <sos>) with their own copy of the generator, into a bounded queue (in shared 
+    memory), with the log-probs of the sampled words (see `policy_log_prob`) and the version of the 
+    weights that sampled them. The learner calls `step` after every generator update, and the weights 
+    are pushed to the workers every `sync_every` updates. Staleness is counted in generator updates, 
+    and rollouts more than `max_staleness` updates old are dropped
+    """
+    def __init__(self, gen, batch_size, num_workers, sync_every=1, max_staleness=4, queue_size=None):
+        self.shared_gen = copy.deepcopy(gen).cpu()
+        self.shared_gen.share_memory()
+        self.version = mp.Value('i', 0)
+        self.lock = mp.Lock()
+        self.queue = mp.Queue(maxsize=queue_size or 2 * num_workers)
+        self.stop = mp.Event()
+        self.sync_every, self.max_staleness = sync_every, max_staleness
+        self.updates, self.dropped = 0, 0
+        self.staleness = RunningStat()
+        self.closed = False
+
+        self.workers = []
+        for i in range(num_workers):
+            worker = mp.Process(target=_rollout_worker, args=(self.shared_gen, self.version, self.lock, 
+                    self.queue, self.stop, batch_size, np.random.randint(2 ** 31) + i))
+            worker.daemon = True
+            worker.start()
+            self.workers += [worker]
+        atexit.register(self.close)
+
+    def get(self, cuda=False):
+        # start tokens, sentences, behaviour log-probs (bs x seq_len) and staleness of the next 
+        # fresh enough rollout
+        while True: 
+            start, sentences, log_prob, version = self.queue.get()
+            staleness = self.updates - version
+            if staleness <= self.max_staleness: break
+            self.dropped += 1
+
+        self.staleness.update(staleness)
+        if cuda: 
+            start, sentences, log_prob = start.cuda(), sentences.cuda(), log_prob.cuda()
+        return start, sentences, log_prob, staleness
+
+    def check(self, gen, cuda=False, tol=1e-3):
+        # one-off sanity check, before any update : workers and learner have the same weights, so 
+        # the importance weights should be 1 (up to cpu / gpu numerical differences)
+        start, sentences, behaviour_log_prob, staleness = self.get(cuda=cuda)
+        assert staleness == 0, 'check before updating the generator'
+        max_diff = (policy_log_prob(gen, start, sentences) - behaviour_log_prob).abs().max().item()
+        if max_diff > tol: 
+            print('RolloutWorkers : behaviour and learner log-probs differ by {:.2e} for the same '
+                  'weights, the importance weights will be off'.format(max_diff))
+
+    def step(self, gen):
+        self.updates += 1
+        if self.updates % self.sync_every == 0: 
+            self.sync(gen)
+
+    def sync(self, gen):
+        with self.lock: 
+            for shared, value in zip(self.shared_gen.state_dict().values(), gen.state_dict().values()):
+                shared.copy_(value)
+            self.version.value = self.updates
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.stop.set()
+        # unblock the workers waiting on a full queue
+        while any(worker.is_alive() for worker in self.workers): 
+            try: 
+                self.queue.get(timeout=0.1)
+            except queue.Empty: 
+                pass
+        for worker in self.workers: 
+            worker.join()
+
+
+def discounted_cumsum(rewards, gamma, block_size=64):
+    """
+    cumulative[:, t] = sum_{k >= t} gamma^(k - t) * rewards[:, k], for rewards of size bs x seq_len.
+    Computed with one (block_size x block_size) triangular discount matrix per block of timesteps, 
+    and a carry between blocks, so memory stays linear in seq_len for very long sequences
+    """
+    bs, seq_len = rewards.size()
+    cumulative  = []
+    carry = None
+    for start in reversed(range(0, seq_len, block_size)):
+        block = rewards[:, start:start + block_size]
+        n = block.size(1)
 
-            # unzip to individual lists
-            b_s, len_s = zip(*b_sorted)
+        # discount[k, t] = gamma^(k - t) if k >= t else 0
+        idx = torch.arange(n, dtype=rewards.dtype, device=rewards.device)
+        diff = idx.view(-1, 1) - idx.view(1, -1)
+        discount = torch.pow(gamma, diff.clamp(min=0)) * (diff >= 0).type_as(rewards)
+        block = block.mm(discount)
 
-            # create pytorch variable, transpose to have (seq, batch)
-            batch_src = torch.LongTensor(b_s)
+        if carry is not None: 
+            # rewards coming from the following blocks
+            block = block + carry.unsqueeze(1) * torch.pow(gamma, n - idx).unsqueeze(0)
 
-            # create the target
-            if True: # args.use_sos_token :
-                target = batch_src
-                input = torch.zeros(batch_src.size())
-                input[:, 0] = SOS_token
-                input[:, 1:] = target[:, :target.size(1) - 1]
-            else: 
-                # we cut the length of each sentence by one
-                target = batch_src[:, 1:]
-                input  = batch_src[:, :-1]
-                len_s  = [x - 1 for x in len_s]
-            
-            input = Variable(input.long())
-            target = Variable(target.long())
-            len_s = torch.LongTensor(len_s)
+        carry = block[:, 0]
+        cumulative = [block] + cumulative
 
-            if args.cuda:
-                input = input.cuda()
-                target = target.cuda()
-                len_s = len_s.cuda()
+    return torch.cat(cumulative, dim=1)
 
-            yield input, target, len_s
-        
 
 def get_cumulative_rewards(disc_logits, args, is_already_reward=False):
     # disc_logits : bs x seq_len 
@@ -160,16 +456,12 @@ def get_cumulative_rewards(disc_logits, args, is_already_reward=False):
         rewards = torch.log(rewards + 1e-7)
 
     bs, seq_len = rewards.size()
-    cumulative_rewards = torch.zeros_like(rewards)
-    for t in reversed(range(seq_len)):
-        if t == seq_len - 1: 
-            cumulative_rewards[:, t] = rewards[:, t]
-            # if in SEQGAN mode, make sure reward only comes from the last timestep
-            if args.seqgan_reward: rewards = rewards * 0. 
-        else:
-            cumulative_rewards[:, t] = rewards[:, t] + args.gamma * cumulative_rewards[:, t+1]
+    if args.seqgan_reward: 
+        # in SEQGAN mode, make sure reward only comes from the last timestep
+        powers = torch.arange(seq_len - 1, -1, -1, dtype=rewards.dtype, device=rewards.device)
+        return rewards[:, [-1]] * torch.pow(args.gamma, powers).unsqueeze(0)
 
-    return cumulative_rewards
+    return discounted_cumsum(rewards, args.gamma)
 
 
 def id_to_words(tensor, word_dict):
@@ -187,9 +479,73 @@ def id_to_words(tensor, word_dict):
     return sentences
 
 
+def init_distributed(args):
+    """
+    With args.distributed, joins the process group set up by torchrun (RANK, WORLD_SIZE, 
+    MASTER_ADDR and MASTER_PORT env variables) with the gloo backend. `apply_loss` then averages 
+    gradients over the processes. Sets args.rank and args.world_size (0 and 1 otherwise)
+    """
+    global WORLD_SIZE, RANK
+    args.rank, args.world_size = 0, 1
+    if not args.distributed: return
+
+    if not dist.is_initialized():
+        dist.init_process_group(backend='gloo', init_method='env://')
+
+        # processes on the same node share its cores
+        local_procs = int(os.environ.get('LOCAL_WORLD_SIZE', dist.get_world_size()))
+        torch.set_num_threads(args.num_threads or max(1, (os.cpu_count() or 1) // local_procs))
+        print('process {}/{} ({} threads)'.format(dist.get_rank(), dist.get_world_size(), torch.get_num_threads()))
+
+    args.rank, args.world_size = dist.get_rank(), dist.get_world_size()
+    RANK, WORLD_SIZE = args.rank, args.world_size
+
+
+@contextlib.contextmanager
+def main_process_first(args):
+    # the other processes wait until the first one is done (e.g. so that it fills a cache once)
+    if args.rank != 0: 
+        dist.barrier()
+    yield
+    if args.rank == 0 and args.world_size > 1: 
+        dist.barrier()
+
+
+def broadcast_params(models):
+    # copies the parameters and buffers of rank 0 to every process
+    if WORLD_SIZE == 1: return
+    for model in models: 
+        for tensor in model.state_dict().values():
+            dist.broadcast(tensor, 0)
+
+
+def all_reduce_grads(params):
+    # averages the gradients of `params` over the processes, with a single (flattened) all-reduce. 
+    # A parameter can get no gradient on some processes only (e.g. an adaptive softmax cluster 
+    # absent from their batch) : it then gets a zero gradient there, so that all of them reduce 
+    # the same layout. Parameters without gradient on every process are left untouched
+    from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+    has_grad = torch.tensor([float(p.grad is not None) for p in params])
+    dist.all_reduce(has_grad)
+    params = [p for (p, has) in zip(params, has_grad.tolist()) if has > 0]
+    if len(params) == 0: return
+
+    for p in params: 
+        if p.grad is None: 
+            p.grad = torch.zeros_like(p)
+    grads = [p.grad.data for p in params]
+    flat = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat)
+    flat.div_(WORLD_SIZE)
+    for grad, reduced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+        grad.copy_(reduced)
+
+
 def apply_loss(optimizer, loss, retain_graph=False, clip_norm=None, stop=False):
     optimizer.zero_grad()
     loss.backward(retain_graph=retain_graph)
+    if WORLD_SIZE > 1: 
+        all_reduce_grads([p for group in optimizer.param_groups for p in group['params']])
     if clip_norm is not None: 
         params = optimizer.param_groups[0]['params']
         torch.nn.utils.clip_grad_norm_(params, clip_norm)
@@ -197,13 +553,164 @@ def apply_loss(optimizer, loss, retain_graph=False, clip_norm=None, stop=False):
     optimizer.step()
 
 
+class RunningStat(object):
+    """
+    Running mean / variance (Welford) / min / max of a scalar metric. The statistics stay on 
+    the device of the values, and `update` never syncs with the host : they are only fetched 
+    when logged (see `print_and_log_scalar`)
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean, self.m2, self.min, self.max = None, None, None, None
+
+    def update(self, value):
+        value = value.detach().float().view(()) if torch.is_tensor(value) else torch.tensor(float(value))
+        self.count += 1
+        if self.count == 1: 
+            self.mean, self.m2 = value.clone(), torch.zeros_like(value)
+            self.min,  self.max = value.clone(), value.clone()
+            return self
+
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2   += delta * (value - self.mean)
+        self.min   = torch.min(self.min, value)
+        self.max   = torch.max(self.max, value)
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    def summary(self):
+        # mean, std, min, max as python floats (a single host sync)
+        return torch.stack([self.mean, self.var.sqrt(), self.min, self.max]).tolist()
+
+
+class AsyncWriter(object):
+    """
+    Stand-in for tensorboardX.SummaryWriter, whose calls are queued and written in batches by a 
+    background thread, so logging doesn't block the training loop. The queue holds at most `max_queue` 
+    entries : when it is full, a new entry waits for at most `put_timeout` seconds, and is then dropped 
+    (with a warning, and counted in `dropped`). Entries are also dropped if the writer thread died
+    """
+    def __init__(self, log_dir, max_queue=10000, max_batch=1000, put_timeout=1.):
+        import tensorboardX
+        self.writer = tensorboardX.SummaryWriter(log_dir=log_dir)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.max_batch = max_batch
+        self.put_timeout = put_timeout
+        self.dropped = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _log(self, method, *args, **kwargs):
+        if not self.thread.is_alive(): 
+            self._drop(args[0] if args else '', 'the writer thread died')
+            return
+        # snapshot the values now : a live tensor / array (e.g. a parameter) could change before it is written
+        snapshot = lambda x: x.copy() if isinstance(x, np.ndarray) else to_cpu_copy(x)
+        args, kwargs = [snapshot(x) for x in args], {k: snapshot(v) for (k, v) in kwargs.items()}
+        try: 
+            self.queue.put((method, args, kwargs), timeout=self.put_timeout)
+        except queue.Full: 
+            self._drop(args[0] if args else '', 'the queue is full')
+
+    def _drop(self, tag, reason):
+        # warn on the first drop, and then every 1000
+        if self.dropped % 1000 == 0: 
+            print('AsyncWriter : dropping log entry {} ({}), {} dropped so far'.format(tag, reason, self.dropped + 1))
+        self.dropped += 1
+
+    def add_scalar(self, *args, **kwargs):
+        self._log('add_scalar', *args, **kwargs)
+
+    def add_histogram(self, *args, **kwargs):
+        self._log('add_histogram', *args, **kwargs)
+
+    def add_image(self, *args, **kwargs):
+        self._log('add_image', *args, **kwargs)
+
+    def add_text(self, *args, **kwargs):
+        self._log('add_text', *args, **kwargs)
+
+    def _write(self):
+        while True: 
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch: 
+                try: 
+                    batch += [self.queue.get_nowait()]
+                except queue.Empty: 
+                    break
+
+            for item in batch: 
+                if item is None: 
+                    self._flush()
+                    return
+                method, args, kwargs = item
+                try: 
+                    getattr(self.writer, method)(*args, **kwargs)
+                except Exception as e: 
+                    print('AsyncWriter : {} {} failed : {}'.format(method, args[0] if args else '', e))
+            self._flush()
+
+    def _flush(self):
+        flush = getattr(self.writer, 'flush', None) or self.writer.file_writer.flush
+        flush()
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        # never wait forever on a writer thread that died or hangs
+        if self.thread.is_alive(): 
+            try: 
+                self.queue.put(None, timeout=10)
+                self.thread.join(timeout=60)
+            except queue.Full: 
+                pass
+        if self.thread.is_alive(): 
+            print('AsyncWriter : the writer thread did not finish, some entries may be lost')
+        else: 
+            self.writer.close()
+        if self.dropped > 0: 
+            print('AsyncWriter : {} log entries were dropped (queue full)'.format(self.dropped))
+
+
+class NullWriter(object):
+    # discards everything (e.g. to benchmark without logging I/O)
+    def add_scalar(self, *args, **kwargs):    pass
+    def add_histogram(self, *args, **kwargs): pass
+    def add_image(self, *args, **kwargs):     pass
+    def add_text(self, *args, **kwargs):      pass
+    def close(self):                          pass
+
+
+def get_writer(log_dir, backend='async'):
+    # tensorboard writer for args.log_backend
+    if backend == 'none': 
+        return NullWriter()
+    if backend == 'async': 
+        return AsyncWriter(log_dir)
+    import tensorboardX
+    return tensorboardX.SummaryWriter(log_dir=log_dir)
+
+
 def print_and_log_scalar(writer, name, value, write_no, end_token=''):
+    if RANK != 0: return # metrics are only reported by the first process
+    extra = ''
+    if isinstance(value, RunningStat): 
+        if value.count == 0: return 
+        value, std, min_, max_ = value.summary()
+        extra = ' (std {:.4f}, min {:.4f}, max {:.4f})'.format(std, min_, max_)
     if isinstance(value, list):
         if len(value) == 0: return 
         value = torch.mean(torch.stack(value))
     zeros = 40 - len(name) 
     name += ' ' * zeros
-    print('{} @ write {} = {:.4f}{}'.format(name, write_no, value, end_token))
+    print('{} @ write {} = {:.4f}{}{}'.format(name, write_no, value, extra, end_token))
     writer.add_scalar(name, value, write_no)
 
 
@@ -227,15 +734,93 @@ def assign_training(iteration, epoch, args):
         raise Exception('should not get here')
 
 
+def sample_many(gen, start_token, sample_size, disc=None, stop_at_eos=False):
+    """
+    Draws `sample_size` sentences from `gen`, `start_token.size(0)` at a time, 
+    directly into a preallocated output buffer (logits are never kept)
+    """
+    bs = start_token.size(0)
+    samples = None
+    with torch.no_grad():
+        for i in range(0, sample_size, bs):
+            words = gen.sample(start_token, disc=disc, keep_logits=False, stop_at_eos=stop_at_eos)[1]
+            if samples is None: 
+                samples = words.new(sample_size, words.size(1)).fill_(PAD_token)
+
+            n = min(bs, sample_size - i)
+            samples[i:i+n, :words.size(1)] = words[:n]
+
+    return samples
+
+
+def score_free_running(gen, oracle, n, alpha=None, seq_len=None, start=None, hidden_state=None, 
+                       oracle_state=None, forced=None, on_step=None, max_batch_size=None):
+    """
+    Samples n sentences with `gen`, and scores every word under `oracle` as it is generated. 
+    Both models are stepped in the same loop, and everything stays on device (no host syncs). 
+    alpha        : overrides the generator's temperature (float, or n x 1 x 1 tensor)
+    start        : n x 1 first input words (default <sos>). With `hidden_state` / `oracle_state` 
+                   (e.g. from `PrefixStateCache`), generation resumes after a prefix
+    forced       : n x seq_len words fed instead of the samples, to score data the same way
+    on_step      : called as on_step(t, input_t, output, hidden_state, logits) at every step
+    max_batch_size : rows are processed in chunks of at most this size (the vocab_size logits of 
+                   every row are allocated at each step). on_step is then called for every chunk
+    returns the words (n x seq_len), their oracle nll (n x seq_len, 0 on <pad>), and the average 
+    nll of every sentence (n) and of every timestep (seq_len)
+    """
+    seq_len = forced.size(1) if forced is not None else (seq_len or gen.args.max_seq_len)
+    if max_batch_size is not None and n > max_batch_size: 
+        from models import slice_hidden
+        rows = lambda x, i, j: None if x is None else x[i:j]
+        words, nll = [], []
+        for i in range(0, n, max_batch_size):
+            j = min(i + max_batch_size, n)
+            chunk_words, chunk_nll, _, _ = score_free_running(gen, oracle, j - i, 
+                    alpha=rows(alpha, i, j) if torch.is_tensor(alpha) else alpha, seq_len=seq_len, 
+                    start=rows(start, i, j), forced=rows(forced, i, j), on_step=on_step, 
+                    hidden_state=None if hidden_state is None else slice_hidden(hidden_state, i, j), 
+                    oracle_state=None if oracle_state is None else slice_hidden(oracle_state, i, j))
+            words += [chunk_words]
+            nll   += [chunk_nll]
+        words, nll = torch.cat(words), torch.cat(nll)
+    else: 
+        alpha = gen.get_alpha(alpha)
+        device = next(gen.parameters()).device
+        input_idx = start if start is not None else \
+                    torch.full((n, 1), SOS_token, dtype=torch.long, device=device)
+
+        words = input_idx.new_full((n, seq_len), PAD_token)
+        nll   = torch.zeros(n, seq_len, device=device)
+
+        for t in range(seq_len):
+            input_t = gen.embedding(input_idx)
+            output, hidden_state = gen.step(input_t, hidden_state, t, var_drop_p=gen.args.var_dropout_p_gen)
+            output_oracle, oracle_state = oracle.step(oracle.embedding(input_idx), oracle_state, t, 
+                                                      var_drop_p=oracle.args.var_dropout_p_gen)
+
+            logits = gen.output_layer(output).squeeze(1)
+            if on_step is not None: 
+                on_step(t, input_t, output, hidden_state, logits)
+
+            if forced is not None: 
+                input_idx = forced[:, [t]]
+            else: 
+                dist = logits if gen.is_oracle else logits * (alpha.view(-1, 1) if torch.is_tensor(alpha) else alpha)
+                input_idx = gen.decoding(dist).unsqueeze(1)
+
+            oracle_log_probs = F.log_softmax(oracle.output_layer(output_oracle).squeeze(1), dim=-1)
+            words[:, t] = input_idx.squeeze(1)
+            nll[:, t]   = -oracle_log_probs.gather(1, input_idx).squeeze(1)
+
+    is_word = (words != PAD_token).float()
+    nll = nll * is_word
+    nll_per_sentence = nll.sum(dim=1) / is_word.sum(dim=1).clamp(min=1)
+    nll_per_timestep = nll.sum(dim=0) / is_word.sum(dim=0).clamp(min=1)
+    return words, nll, nll_per_sentence, nll_per_timestep
+
+
 def generate_file(gen, first_token, name='output.txt'):
-    num_rounds = 10000 // first_token.size(0) + 1
-    output = []
-    for _ in range(num_rounds):
-        sentence = gen(first_token)[1].data
-        output.append(sentence)
-
-    output = torch.cat(output, dim=0).cpu().numpy()
-    output = output[:10000]
+    output = sample_many(gen, first_token, 10000).cpu().numpy()
     with open(name, 'w') as f: 
         for line in output:
             xx = str(line)[1:-1]
@@ -294,6 +879,109 @@ def save_models(models, base_dir, epoch):
     print('saved {} models'.format(len(models)))
     
 
+def get_rng_state():
+    # everything needed to replay the same random stream (dropout, sampling, shuffling)
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_cpu_copy(obj):
+    # deep copy of (nested) tensors to cpu, so training can keep updating the originals
+    if torch.is_tensor(obj):
+        return obj.detach().cpu() if obj.is_cuda else obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((k, to_cpu_copy(v)) for (k, v) in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu_copy(v) for v in obj)
+    return obj
+
+
+class Checkpointer(object):
+    """
+    Full training state checkpoints in `base_dir/checkpoints`. `save` snapshots the state to cpu 
+    and writes it from a background thread (to a tmp file, then renamed, so a crash never leaves
+    a truncated checkpoint). Only the last `keep` checkpoints are kept, and older ones are also 
+    removed while the total exceeds `max_mb` (0 : no size limit)
+    """
+    def __init__(self, base_dir, keep=3, max_mb=0):
+        self.dir = os.path.join(base_dir, 'checkpoints')
+        self.keep = keep
+        self.max_bytes = max_mb * 2 ** 20
+        self.thread = None
+        self.error = None
+
+    def path(self, step):
+        return os.path.join(self.dir, 'ckpt{}.pth'.format(step))
+
+    def checkpoints(self):
+        # (step, path) of completed checkpoints, oldest first
+        if not os.path.isdir(self.dir): return []
+        steps = [int(f[4:-4]) for f in os.listdir(self.dir) if f.startswith('ckpt') and f.endswith('.pth')]
+        return [(step, self.path(step)) for step in sorted(steps)]
+
+    def save(self, state, step):
+        state = to_cpu_copy(state)
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state, step))
+        self.thread.start()
+
+    def _write(self, state, step):
+        try: 
+            self._save(state, step)
+        except Exception as e: 
+            self.error = e # raised by `wait`, on the training thread
+
+    def _save(self, state, step):
+        maybe_create_dir(self.dir)
+        path = self.path(step)
+        with open(path + '.tmp', 'wb') as f: 
+            torch.save(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._prune()
+        print('saved checkpoint {}'.format(path))
+
+    def _prune(self):
+        ckpts = self.checkpoints()
+        sizes = [os.path.getsize(path) for (_, path) in ckpts]
+        while len(ckpts) > 1 and (len(ckpts) > self.keep or \
+                (self.max_bytes > 0 and sum(sizes) > self.max_bytes)):
+            os.remove(ckpts.pop(0)[1])
+            sizes.pop(0)
+
+    def wait(self):
+        if self.thread is not None: 
+            self.thread.join()
+            self.thread = None
+        if self.error is not None: 
+            error, self.error = self.error, None
+            raise error
+
+    def load(self, path=None):
+        # most recent checkpoint if no path is given, None if there is none
+        if path is None: 
+            ckpts = self.checkpoints()
+            if len(ckpts) == 0: return None
+            path = ckpts[-1][1]
+        print('resuming from {}'.format(path))
+        # checkpoints hold more than tensors (e.g. the numpy RNG state), which newer torch 
+        # versions refuse to unpickle by default
+        import inspect
+        kwargs = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+        return torch.load(path, map_location=lambda storage, loc: storage, **kwargs)
+
+
 def print_and_save_args(args, path):
     print(args)
     # let's save the args as json to enable easy loading
@@ -317,17 +1005,12 @@ def to_attr(args_dict):
 
 
 def remove_pad_tokens(tensor, index):
+    # mean of `tensor` over the non <pad> entries of `index` (-0.1 if there are none). No host sync
     assert len(tensor.shape) == 1 and len(index.shape) == 1
     is_not_pad = (index != 0).float()
     summ = (tensor * is_not_pad).sum(dim=0)
     is_not_pad = is_not_pad.sum()
-    if is_not_pad == 0: 
-        print('batch is only PAD token')
-        return summ * 0. + -.1
-    else: 
-        print('batch contains %d / %d active sentences' % (is_not_pad.item(), tensor.size(0)))
-
-    return summ / is_not_pad
+    return torch.where(is_not_pad > 0, summ / is_not_pad.clamp(min=1), torch.full_like(summ, -.1))
 
 
 def get_cot_args(args):
@@ -356,6 +1039,7 @@ def get_oracle(args=None):
     args_copy.rnn = 'LSTM'
     args_copy.var_dropout_p_gen = 0.
     args_copy.leak_info = False
+    args_copy.output_layer = 'dense'
     oracle =  Generator(args_copy, is_oracle=True)
     oracle = oracle.eval()
     
@@ -396,6 +1080,10 @@ def get_oracle(args=None):
     return oracle
 
 
+# args missing from the args.json of models trained before they were introduced
+OLD_MODEL_ARGS = {'leak_info': False, 'output_layer': 'dense', 'adaptive_cutoffs': [2000, 10000], 'num_sampled': 1024}
+
+
 def load_model_from_file(path, args=None, epoch=None, model='gen'):
     import json
     from models import Generator, Discriminator
@@ -406,8 +1094,9 @@ def load_model_from_file(path, args=None, epoch=None, model='gen'):
     args_dict = vars(args)
     for key in args_dict.keys():
         if key not in old_args:
-            if key == 'leak_info':
-                old_args[key] = False
+            if key in OLD_MODEL_ARGS:
+                # these change the model's parameters : use what older models were built with
+                old_args[key] = OLD_MODEL_ARGS[key]
             else: 
                 print('Warning: new arg \'{}\' given value \'{}\''.format(key, args_dict[key]))
                 old_args[key] = args_dict[key]
@@ -442,3 +1131,40 @@ def transfer_weights(gen, disc):
     # 2) transfer RNN weights
     for rnn_disc, rnn_gen in zip(disc.rnns, gen.rnns):
         rnn_disc.load_state_dict(rnn_gen.state_dict())
+
+
+if __name__ == '__main__':
+    # micro-benchmark : minibatch throughput in padded mode
+    lengths = np.random.randint(5, 60, size=200000)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    dataset = Corpus(np.random.randint(4, 10000, size=offsets[-1]).astype(np.int32), offsets)
+    for mask_padding in [False, True]:
+        args = to_attr({'batch_size' : 128, 'max_seq_len' : 51, 'mask_padding' : mask_padding, 
+                        'stream_data' : False, 'cuda' : False})
+        start = time.time()
+        num_batches = sum(1 for _ in minibatch_generator(dataset, args))
+        print('padded minibatches (mask_padding={}) : {:.0f} batches / s'.format(mask_padding, \
+                num_batches / (time.time() - start)))
+
+    # micro-benchmark : discounted returns, vectorized vs. one timestep at a time
+    args = to_attr({'gamma' : 0.95, 'seqgan_reward' : 0})
+
+    def reversed_loop(rewards, args):
+        cumulative_rewards = torch.zeros_like(rewards)
+        for t in reversed(range(rewards.size(1))):
+            if t == rewards.size(1) - 1: 
+                cumulative_rewards[:, t] = rewards[:, t]
+            else:
+                cumulative_rewards[:, t] = rewards[:, t] + args.gamma * cumulative_rewards[:, t+1]
+        return cumulative_rewards
+
+    for seq_len in [20, 51, 1000]:
+        disc_logits = torch.randn(128, seq_len)
+        rewards = torch.log(F.sigmoid(disc_logits + 1e-7) + 1e-7)
+        assert torch.allclose(reversed_loop(rewards, args), get_cumulative_rewards(disc_logits, args), atol=1e-4)
+
+        for name, fn in [('reversed loop', lambda : reversed_loop(rewards, args)), 
+                         ('vectorized', lambda : get_cumulative_rewards(disc_logits, args))]:
+            start = time.time()
+            for _ in range(100): fn()
+            print('seq_len {:<5} {:<15} {:.3f} ms / call'.format(seq_len, name, (time.time() - start) * 10))
@@ -36,12 +36,13 @@ test_batch  = next(minibatch_generator(dataset_test,  args, shuffle=False))
 # load model that will be evaluated
 gen, loaded_epoch = load_model_from_file(args.model_path, epoch=args.model_epoch)
 gen.args.alpha_test = args.alpha_test
+gen.decoding = DecodingStrategy.from_args(args)
 gen.eval()
 print('switching the temperature to {}'.format(gen.args.alpha_test))
 
 # Logging
-writer = tensorboardX.SummaryWriter(log_dir=os.path.join(args.model_path, \
-        'TB_alpha{}'.format(gen.args.alpha_test)))
+writer = get_writer(os.path.join(args.model_path, \
+        'TB_alpha{}'.format(gen.args.alpha_test)), args.log_backend)
 writes = 0
 
 if args.lm_path: 
@@ -61,61 +62,41 @@ with torch.no_grad():
     for mode, data, hs_dict, oracle_nlls, embeddings in MODE: 
         input, _, _ = data
 
-        # here we basically expose the model's forward pass to fetch the hidden states efficiently
+        # generator and oracle are stepped together by `score_free_running`, which either samples 
+        # or is fed the data. We only fetch the hidden states / embeddings for T-SNE
         teacher_force = mode != 'free_running'
         print('teacher forcing : {}'.format(teacher_force))
-        hidden_state, hidden_state_oracle = None, None
+        entropies = []
 
-        for t in range(args.tsne_max_t):
-            if teacher_force or t == 0: 
-                input_idx = input[:, [t]]
-
-            input_t = gen.embedding(input_idx)
-            output, hidden_state = gen.step(input_t, hidden_state, t)
-            embeddings += [input_t.cpu().data.numpy()]
-            
-            if args.lm_path: 
-                if t > 0: 
-                    # query the oracle for NLL of the next word (i.e. use x_t to index p(x_t | x_{i<t})
-                    # oracle_nlls += [-1. * oracle_dist.log_prob(input_idx.squeeze()).mean(dim=0).item()]
-                    oracle_nll_t = -1. * oracle_dist.log_prob(input_idx.squeeze())
-                    oracle_nlls += [remove_pad_tokens(oracle_nll_t, input_idx.squeeze()).item()]
-                    full_oracle_nll = oracle_nll_t.view(-1,1) if t==1 \
-                        else torch.cat((full_oracle_nll,oracle_nll_t.view(-1,1)),1)
-
-                # feed the current word to the model. 
-                input_oracle = oracle_lm.embedding(input_idx)
-                output_oracle, hidden_state_oracle = oracle_lm.step(input_oracle, \
-                        hidden_state_oracle, t)
-                oracle_dist = oracle_lm.output_layer(output_oracle)
-                oracle_dist = Categorical(logits=oracle_dist.squeeze(1))
-           
+        def on_step(t, input_t, output, hidden_state, logits):
+            embeddings.append(input_t.cpu().data.numpy())
             # compute entropy (! does not take care of <pad>)
-            dist = gen.output_layer(output)
-            entropy = Categorical(logits=dist.squeeze(1)).entropy().cpu().numpy().mean()
-            print_and_log_scalar(writer, 'eval/%s_entropy' % mode, entropy, t) 
-
-            if not teacher_force: 
-                dist = gen.output_layer(output)
-                dist *= gen.args.alpha_test
-                input_idx = Categorical(logits=dist.squeeze(1)).sample().unsqueeze(1)
-                fake_sentences = input_idx if t==0 else torch.cat((fake_sentences,input_idx), 1)
+            entropies.append(Categorical(logits=logits).entropy().mean())
 
             if (t+1) % args.tsne_log_every == 0: 
                 # for lstm we take the hidden state (i.e. h_t of (h_t, c_t))
                 hs = hidden_state[0] if isinstance(hidden_state, tuple) else hidden_state
                 hs_dict[t] = hs.cpu().data.numpy()
 
-            if (t+1) % args.oracle_nll_log_every == 0 and args.lm_path and t > 0: 
-                p_x_1t = sum(oracle_nlls)
-                p_x_t = oracle_nlls[-1]
-                print_and_log_scalar(writer, 'eval/%s_oracle_nll' % mode, p_x_t, t) 
+        # the word read at the last step is not scored, so data is padded by one word
+        forced = torch.cat([input[:, 1:], torch.full_like(input[:, [0]], PAD_token)], dim=1) \
+                    if teacher_force else None
+        fake_sentences, full_oracle_nll, avg_oracle_nll, oracle_nll_t = score_free_running(gen, 
+                oracle_lm, input.size(0), seq_len=args.tsne_max_t, start=input[:, [0]], forced=forced, 
+                on_step=on_step)
+
+        for t, entropy in enumerate(torch.stack(entropies).cpu().numpy()):
+            print_and_log_scalar(writer, 'eval/%s_entropy' % mode, entropy, t) 
+
+        # nll of the word read at step t (logged at t, as it was predicted at t-1)
+        oracle_nlls += oracle_nll_t[:-1].cpu().numpy().tolist()
+        for t in range(1, args.tsne_max_t): 
+            if (t+1) % args.oracle_nll_log_every == 0: 
+                print_and_log_scalar(writer, 'eval/%s_oracle_nll' % mode, oracle_nlls[t-1], t) 
 
         # print most/less likely sequences
         seq = input[:,1:] if teacher_force else fake_sentences
-        seq_len = (seq != 0).sum(1)
-        tot_oracle_nll = full_oracle_nll.sum(1)
-        avg_oracle_nll = tot_oracle_nll.cpu().numpy() / seq_len.cpu().numpy()
+        avg_oracle_nll = avg_oracle_nll.cpu().numpy()
 
         sentences = id_to_words(seq.cpu().data.numpy(), word_dict)
         sorted_idx = np.argsort(avg_oracle_nll)
@@ -363,70 +344,64 @@ if args.run_rlm:
 ### TODO() make 100% sure there is no bug
 if args.run_sc:
 
+    # prefix states of gen and oracle_lm, shared by every breakpoint
+    prefix_cache = PrefixStateCache(max_bytes=args.prefix_cache_mb << 20)
+
     with torch.no_grad():
         input, _, _ = test_batch
 
-        for t in range(args.tsne_max_t):
-
-            teacher_force = True if t<args.breakpoint else False
-
-            if teacher_force or t == 0: 
-                input_idx = input[:, [t]]
-
-            input_t = gen.embedding(input_idx)
-            output, hidden_state = gen.step(input_t, hidden_state, t)
-            
-            if t >= args.breakpoint: 
-                # query the oracle for NLL of the next word (i.e. use x_t to index p(x_t | x_{i<t})
-                # oracle_nlls += [-1. * oracle_dist.log_prob(input_idx.squeeze()).mean(dim=0).item()]
-                oracle_nll_t = -1. * oracle_dist.log_prob(input_idx.squeeze())
-                oracle_nlls += [remove_pad_tokens(oracle_nll_t, input_idx.squeeze()).item()]
-                full_oracle_nll = oracle_nll_t.view(-1,1) if t==1 \
-                        else torch.cat((full_oracle_nll,oracle_nll_t.view(-1,1)),1)
-
-            # feed the current word to the model. 
-            input_oracle = oracle_lm.embedding(input_idx)
-            output_oracle, hidden_state_oracle = oracle_lm.step(input_oracle, \
-                    hidden_state_oracle, t)
-            oracle_dist = oracle_lm.output_layer(output_oracle)
-            oracle_dist = Categorical(logits=oracle_dist.squeeze(1))
-           
-
-            if not teacher_force: 
-                dist = gen.output_layer(output)
-                dist *= gen.args.alpha_test
-                input_idx = Categorical(logits=dist.squeeze(1)).sample().unsqueeze(1)
-            
-            # this should work but make sure it does:
-            fake_sentences = input_idx if t==0 else torch.cat((fake_sentences,input_idx), 1)
-
-
-        p_x_bt = sum(oracle_nlls)
-
-        # print most/less likely sequences
-        seq = fake_sentences
-        seq_len = (seq != 0).sum(1)
-        tot_oracle_nll = full_oracle_nll.sum(1)
-        avg_oracle_nll = tot_oracle_nll.cpu().numpy() / seq_len.cpu().numpy()
-
-        sentences = id_to_words(seq.cpu().data.numpy(), word_dict)
-        sorted_idx = np.argsort(avg_oracle_nll)
-
-        if args.character_level: sentences = remove_sep_spaces(sentences)
+        for breakpoint in sorted(args.breakpoints or [args.breakpoint]): 
+            # the first `breakpoint` words (<sos> included) are given, the rest is completed
+            prefix = input[:, :breakpoint]
+            completion_len = args.tsne_max_t - breakpoint
+            hidden_state        = prefix_cache.encode('gen', gen, input, breakpoint - 1, key='test')
+            hidden_state_oracle = prefix_cache.encode('oracle', oracle_lm, input, breakpoint - 1, key='test')
+
+            if args.decoding == 'beam': 
+                completion, _ = gen.beam_search(prefix[:, [-1]], hidden_state, beam_size=args.beam_size, 
+                        seq_len=completion_len, length_penalty=args.length_penalty)
+            elif args.decoding == 'greedy': 
+                completion = gen.greedy(prefix[:, [-1]], hidden_state, seq_len=completion_len)
+            else: 
+                completion = gen.sample(prefix[:, [-1]], hidden_state, seq_len=completion_len, 
+                        keep_logits=False)[1]
+
+            # query the oracle for the NLL of every completed word, resuming after the prefix
+            oracle_input  = torch.cat([prefix[:, [-1]], completion[:, :-1]], dim=1)
+            oracle_logits = oracle_lm.output_layer(oracle_lm.features(oracle_input, hidden_state_oracle))
+            full_oracle_nll = token_nll(oracle_logits, completion)
+            full_oracle_nll = full_oracle_nll * (completion != PAD_token).float()
+            fake_sentences = torch.cat([prefix[:, 1:], completion], dim=1)
+
+            # print most/less likely sequences
+            seq = fake_sentences
+            # (the nll of the completion is averaged over the whole sentence, <sos> and prefix included, 
+            # as the reported completion lm scores always were)
+            seq_len = (torch.cat([prefix, completion], dim=1) != PAD_token).sum(1)
+            tot_oracle_nll = full_oracle_nll.sum(1)
+            avg_oracle_nll = tot_oracle_nll.cpu().numpy() / seq_len.cpu().numpy()
+
+            sentences = id_to_words(seq.cpu().data.numpy(), word_dict)
+            sorted_idx = np.argsort(avg_oracle_nll)
+
+            if args.character_level: sentences = remove_sep_spaces(sentences)
         
-        print("most likely sentences under oracle:")
-        for i in range(10):
-            print(sentences[sorted_idx[i]])
-            print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[i]]))
+            print("most likely sentences under oracle:")
+            for i in range(10):
+                print(sentences[sorted_idx[i]])
+                print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[i]]))
         
-        print("least likely sentences under oracle:")
-        for i in range(1,11):
-            print(sentences[sorted_idx[-i]])
-            print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[-i]]))
+            print("least likely sentences under oracle:")
+            for i in range(1,11):
+                print(sentences[sorted_idx[-i]])
+                print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[-i]]))
 
-        # store LM score
-        lm_score = np.mean(avg_oracle_nll)
-        print_and_log_scalar(writer, 'eval/completion_lm_score_b{}'.format(args.breakpoint), lm_score, 0)
+            # store LM score
+            lm_score = np.mean(avg_oracle_nll)
+            decoding = '' if args.decoding == 'sample' else '_' + args.decoding
+            print_and_log_scalar(writer, 'eval/completion_lm_score_b{}{}'.format(breakpoint, decoding), lm_score, 0)
+
+    print('prefix cache : {} hits, {} misses'.format(prefix_cache.hits, prefix_cache.misses))
 
 
     """ run reverse LM score on the sentence completed dataset """
@@ -32,12 +32,13 @@ test_batch  = next(minibatch_generator(dataset_test,  args, shuffle=False))
 # load model that will be evaluated
 gen, loaded_epoch = load_model_from_file(args.model_path, epoch=args.model_epoch)
 gen.args.alpha_test = args.alpha_test
+gen.decoding = DecodingStrategy.from_args(args)
 gen.eval()
 print('switching the temperature to {}'.format(gen.args.alpha_test))
 
 # Logging
-writer = tensorboardX.SummaryWriter(log_dir=os.path.join(args.model_path, \
-        'TB_alpha{}'.format(gen.args.alpha_test)))
+writer = get_writer(os.path.join(args.model_path, \
+        'TB_alpha{}'.format(gen.args.alpha_test)), args.log_backend)
 writes = 0
 
 if args.cuda: 
@@ -49,7 +50,7 @@ def save_samples_for_bleu(gen, input, word_dict, epoch, sample_size=10000):
         with open(file_name, 'w') as f:
             tot_sent=0
             while tot_sent < sample_size:
-                _, fake_sentences = gen(input[:, [0]])
+                _, fake_sentences = gen.sample(input[:, [0]], keep_logits=False, stop_at_eos=True)
                 sentences = id_to_words(fake_sentences.cpu().data.numpy(), word_dict)
                 for sentence in sentences: 
                     xx = str(sentence) #[1:-1]
@@ -1,5 +1,6 @@
 import argparse
 import pdb
+import random
 import numpy as np
 import torch
 import torch.optim as optim
@@ -17,17 +18,20 @@ def main(rlm=False, rlm_dir=None):
 
     args = get_train_args()
 
-    # reproducibility
+    # reproducibility (the python / numpy seeds also keep the data shards of all processes in sync)
     torch.manual_seed(2)
     np.random.seed(2)
-
-    # dataset creation
-    dataset_train, word_dict = tokenize(os.path.join(args.data_dir, 'train.txt'), \
-            train=True, char_level=args.character_level, dataset=args.dataset)
-    dataset_valid,  word_dict = tokenize(os.path.join(args.data_dir, 'valid.txt'), train=False, \
-            word_dict=word_dict, char_level=args.character_level, dataset=args.dataset)
-    dataset_test,  word_dict = tokenize(os.path.join(args.data_dir, 'test.txt'), train=False, \
-            word_dict=word_dict, char_level=args.character_level, dataset=args.dataset)
+    random.seed(2)
+    init_distributed(args)
+
+    # dataset creation (done by the first process, the others then load it from the cache)
+    with main_process_first(args):
+        dataset_train, word_dict = tokenize(os.path.join(args.data_dir, 'train.txt'), \
+                train=True, char_level=args.character_level, dataset=args.dataset)
+        dataset_valid,  word_dict = tokenize(os.path.join(args.data_dir, 'valid.txt'), train=False, \
+                word_dict=word_dict, char_level=args.character_level, dataset=args.dataset)
+        dataset_test,  word_dict = tokenize(os.path.join(args.data_dir, 'test.txt'), train=False, \
+                word_dict=word_dict, char_level=args.character_level, dataset=args.dataset)
 
     if rlm:
         args = get_rlm_args()
@@ -38,17 +42,20 @@ def main(rlm=False, rlm_dir=None):
     # add extra args
     args.vocab_size = len(word_dict)
     args.cuda = False if args.no_cuda else True
-
-    # Logging
-    maybe_create_dir(args.base_dir)
-    maybe_create_dir(os.path.join(args.base_dir, 'samples'))
-    maybe_create_dir(os.path.join(args.base_dir, 'models'))
-    print_and_save_args(args, args.base_dir)
-    writer = tensorboardX.SummaryWriter(log_dir=os.path.join(args.base_dir, 'TB'))
+    init_distributed(args) # (again, as args are replaced in rlm mode)
+    is_main = args.rank == 0
+    
+    # Logging (only done by the first process in distributed mode)
+    if is_main: 
+        maybe_create_dir(args.base_dir)
+        maybe_create_dir(os.path.join(args.base_dir, 'samples'))
+        maybe_create_dir(os.path.join(args.base_dir, 'models'))
+        print_and_save_args(args, args.base_dir)
+    writer = get_writer(os.path.join(args.base_dir, 'TB'), args.log_backend) if is_main else NullWriter()
     writes = 0
     best_valid, best_test = 1e5, 1e5
 
-    gen  = Generator(args)
+    gen  = Generator(args, counts=word_counts(word_dict, dataset_train))
     disc = Discriminator(args)
 
     if args.load_gen_path:
@@ -65,6 +72,10 @@ def main(rlm=False, rlm_dir=None):
         disc = disc.cuda()
         if args.lm_path: oracle_lm = oracle_lm.cuda()
 
+    # every process starts from the same weights, but draws different samples
+    broadcast_params([gen, disc])
+    if args.world_size > 1: torch.manual_seed(2 + args.rank)
+
     optimizer_gen    = optim.Adam(gen.parameters(),         lr=args.gen_lr)
     optimizer_critic = optim.Adam(disc.critic.parameters(), lr=args.critic_lr)
     optimizer_disc   = optim.Adam([p for (n,p) in disc.named_parameters() if 'critic' not in n], lr=args.disc_lr)
@@ -72,31 +83,61 @@ def main(rlm=False, rlm_dir=None):
     # makes logging easier
     MODELS = [ ('gen', gen, optimizer_gen), ('disc', disc, optimizer_disc), ('critic', None, optimizer_critic)]
 
+    # full training state, so that a preempted run can pick up where it left off
+    checkpointer = Checkpointer(args.base_dir, args.keep_checkpoints, args.keep_checkpoints_mb)
+    def training_state(phase, epoch):
+        return {'phase': phase, 'epoch': epoch, 'writes': writes, 
+                'best_valid': best_valid, 'best_test': best_test, 
+                'models': {name: model.state_dict() for (name, model, _) in MODELS if model is not None},
+                'optimizers': {name: opt.state_dict() for (name, _, opt) in MODELS}, 
+                'rng': get_rng_state()}
+
+    mle_start, adv_start = 0, 0
+    ckpt = None
+    if args.resume: 
+        ckpt = checkpointer.load(None if args.resume == 'latest' else args.resume)
+    if ckpt is not None: 
+        for name, model, opt in MODELS:
+            if model is not None: model.load_state_dict(ckpt['models'][name])
+            opt.load_state_dict(ckpt['optimizers'][name])
+        writes, best_valid, best_test = ckpt['writes'], ckpt['best_valid'], ckpt['best_test']
+        set_rng_state(ckpt['rng'])
+        if args.world_size > 1: torch.manual_seed(ckpt['writes'] * args.world_size + args.rank)
+        if ckpt['phase'] == 'mle': 
+            mle_start = ckpt['epoch'] + 1
+        else: 
+            mle_start, adv_start = args.mle_epochs, ckpt['epoch'] + 1
+
 
     '''
     MLE pretraining
     '''
-    for epoch in range(args.mle_epochs):
+    for epoch in range(mle_start, args.mle_epochs):
         print('MLE pretraining epoch {}/{}'.format(epoch, args.mle_epochs))
-        train_loader = minibatch_generator(dataset_train, args, shuffle=True)
-        losses_train, losses_dev, oracle_nlls = [], [], []
+        data_stats = {}
+        train_loader = get_loader(dataset_train, args, shuffle=True, \
+                bucket=args.bucket_batches, stats=data_stats, shard=(args.rank, args.world_size))
+        losses_train, losses_dev, oracle_nlls = RunningStat(), RunningStat(), RunningStat()
         gen.train()
 
         # Training loop
         for i, minibatch in enumerate(train_loader):
             input, target, lens = minibatch
             
-            gen_logits, _ = gen(input)
-            loss = masked_cross_entropy(gen_logits, target, lens)
-            losses_train += [loss.data]
+            loss = gen.mle_loss(input, target, lens)
+            losses_train.update(loss.data)
             apply_loss(optimizer_gen, loss, clip_norm=args.grad_clip)
+        train_loader.close()
         
+        if padding_ratio(data_stats) is not None: 
+            print_and_log_scalar(writer, 'train/padding ratio', padding_ratio(data_stats), writes)
+        print_and_log_scalar(writer, 'train/data stall ratio', train_loader.stall_ratio(), writes)
         print_and_log_scalar(writer, 'train/nll', losses_train, writes, end_token='\n')
 
-        if (epoch + 1) % args.test_every == 0:
+        if (epoch + 1) % args.test_every == 0 and is_main:
             for split in ['valid','test']:
                 dataset = dataset_valid if split=='valid' else dataset_test
-                loader_dev  = minibatch_generator(dataset,  args, shuffle=False)
+                loader_dev  = get_loader(dataset,  args, shuffle=False)
                 with torch.no_grad():
                     gen.eval()
 
@@ -104,9 +145,8 @@ def main(rlm=False, rlm_dir=None):
                     for i, minibatch in enumerate(loader_dev):
                         input, target, lens = minibatch
 
-                        gen_logits, _ = gen(input)
-                        loss = masked_cross_entropy(gen_logits, target, lens)
-                        losses_dev += [loss.data]
+                        loss = gen.mle_loss(input, target, lens)
+                        losses_dev.update(loss.data)
 
                         if args.lm_path: 
                             # generate a sentence, a sentence, and feed to oracle lm
@@ -115,19 +155,21 @@ def main(rlm=False, rlm_dir=None):
                             oracle_logits, _ = oracle_lm(oracle_input.detach())
                         
                             nll = NLL(oracle_logits[:, :-1], gen_sample)
-                            oracle_nlls += [nll.data] 
+                            oracle_nlls.update(nll.data) 
+                    loader_dev.close()
 
                     print_and_log_scalar(writer, '{}/oracle_nll'.format(split), oracle_nlls, writes)
                     print_and_log_scalar(writer, '{}/nll'.format(split), losses_dev, writes, end_token='\n')
 
                     # keep tab of best valid error in order to get legit test error:
                     if split == 'valid':
-                        curr_valid_loss = np.mean(losses_dev)
+                        curr_valid_loss = losses_dev.mean.item()
                         best_valid = min(best_valid,curr_valid_loss)
                     if split == 'test':
-                        best_test = np.mean(losses_dev) if best_valid==curr_valid_loss else best_test
+                        best_test = losses_dev.mean.item() if best_valid==curr_valid_loss else best_test
                         
         writes += 1
+        if not is_main: continue
            
         # save samples
         gen.eval()
@@ -137,23 +179,39 @@ def main(rlm=False, rlm_dir=None):
         if (epoch + 1) % args.save_every == 0: 
             save_models(MODELS[0:1], args.base_dir, writes)
 
+        if (epoch + 1) % args.checkpoint_every == 0 or epoch + 1 == args.mle_epochs: 
+            checkpointer.save(training_state('mle', epoch), writes)
+
     # if in rlm mode, store the rlm_score
     if rlm:
+        checkpointer.wait()
         return best_test
 
-    if args.transfer_weights_after_pretraining and args.mle_epochs > 0:
+    # (weights were already transferred if we resume from adversarial training)
+    resumed_adv = ckpt is not None and ckpt['phase'] == 'adv'
+    if args.transfer_weights_after_pretraining and args.mle_epochs > 0 and not resumed_adv:
         transfer_weights(gen, disc)
         print('transfered weights from generator to discriminator')
 
 
+    # fake sentences can be sampled by worker processes while we train on the previous ones
+    rollouts = None
+    if args.rollout_workers > 0 and args.stream_data: 
+        raise ValueError('rollout workers sample from <sos>, which streamed batches do not start with')
+    if args.rollout_workers > 0 and adv_start < args.adv_epochs: 
+        rollouts = RolloutWorkers(gen, args.batch_size, args.rollout_workers, 
+                sync_every=args.rollout_sync_every, max_staleness=args.max_staleness)
+        rollouts.check(gen, cuda=args.cuda)
+
+
     '''
     Adversarial training
     '''
-    for epoch in range(args.adv_epochs):
+    for epoch in range(adv_start, args.adv_epochs):
         print('ADV training epoch {}'.format(epoch))
-        train_loader = minibatch_generator(dataset_train, args, shuffle=True)
+        train_loader = get_loader(dataset_train, args, shuffle=True, shard=(args.rank, args.world_size))
         gen_losses, disc_losses, critic_losses, ps_real, ps_fake, real_accs, fake_accs, nlls = \
-                [[] for _ in range(8)]
+                [RunningStat() for _ in range(8)]
         gen.train(); disc.train()
 
         # Training loop
@@ -168,20 +226,23 @@ def main(rlm=False, rlm_dir=None):
                 p_real = F.sigmoid(real_out)
                 real_acc = (p_real[:, -1] > 0.5).type(torch.float).mean().data
                 p_real = p_real.mean().data
-                ps_real += [p_real]
-                real_accs += [real_acc]
+                ps_real.update(p_real)
+                real_accs.update(real_acc)
                                
                 # train disc on fake data
-                _, fake_sentences = gen(input[:, [0]])
+                if rollouts is None: 
+                    _, fake_sentences = gen(input[:, [0]])
+                else: 
+                    _, fake_sentences, _, _ = rollouts.get(cuda=args.cuda)
                 fake_out, fake_baseline = disc(fake_sentences.detach())
                 fake_loss = F.binary_cross_entropy_with_logits(fake_out, torch.zeros_like(fake_out))
                 p_fake = F.sigmoid(fake_out)
                 fake_acc = (p_fake[:, -1] < 0.5).type(torch.float).mean().data
                 p_fake = p_fake.mean().data
-                ps_fake += [p_fake]
-                fake_accs += [fake_acc]
+                ps_fake.update(p_fake)
+                fake_accs.update(fake_acc)
                 disc_loss = (fake_loss + real_loss) / 2
-                disc_losses += [disc_loss.data]
+                disc_losses.update(disc_loss.data)
 
                 apply_loss(optimizer_disc, disc_loss, clip_norm=args.grad_clip)
                 
@@ -189,30 +250,44 @@ def main(rlm=False, rlm_dir=None):
                 if args.use_baseline: 
                     cumulative_rewards = get_cumulative_rewards(fake_out, args)
                     critic_loss = reinforce_critic_loss(cumulative_rewards, fake_baseline)
-                    critic_losses += [critic_loss.data]            
+                    critic_losses.update(critic_loss.data)            
 
                     apply_loss(optimizer_critic, critic_loss, clip_norm=args.grad_clip)
             
             if should_train_gen:
                 # train generator
-                fake_logits, fake_sentence = gen(input[:, [0]])
+                if rollouts is None: 
+                    fake_logits, fake_sentence = gen(input[:, [0]])
+                    is_weights = None
+                else: 
+                    # the rollout may come from older weights : get the current logits by teacher forcing. 
+                    # Like in the workers (see `policy_log_prob`) this pass runs without dropout, so that 
+                    # the same logits give the gradient and the importance weights
+                    start, fake_sentence, behaviour_log_prob, _ = rollouts.get(cuda=args.cuda)
+                    gen.eval()
+                    fake_logits, _ = gen(torch.cat([start, fake_sentence[:, :-1]], dim=1))
+                    gen.train()
+                    log_prob = word_log_prob(fake_logits.detach(), fake_sentence)
+                    is_weights = truncated_importance_weights(log_prob, behaviour_log_prob, args.is_clip)
                 fake_out, fake_baseline = disc(fake_sentence.detach())
                 cumulative_rewards = get_cumulative_rewards(fake_out, args)
                 gen_loss = reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, 
-                                              fake_baseline, args)
-                gen_losses += [gen_loss.data]
+                                              fake_baseline, args, is_weights=is_weights)
+                gen_losses.update(gen_loss.data)
 
                 apply_loss(optimizer_gen, gen_loss, clip_norm=args.grad_clip)
+                if rollouts is not None: rollouts.step(gen)
 
             if should_train_mle:
-                fake_logits, _  = gen(input)
-                nll = masked_cross_entropy(fake_logits, target, lens)
-                nlls += [nll.data]
+                nll = gen.mle_loss(input, target, lens)
+                nlls.update(nll.data)
                 
                 apply_loss(optimizer_gen, nll, clip_norm=args.grad_clip)
+        train_loader.close()
             
 
         # logging
+        print_and_log_scalar(writer, 'train/data stall ratio', train_loader.stall_ratio(), writes)
         print_and_log_scalar(writer, 'train/P(real)', ps_real, writes)      
         print_and_log_scalar(writer, 'train/real Accuracy', real_accs, writes)
         print_and_log_scalar(writer, 'train/P(fake)', ps_fake, writes)      
@@ -221,13 +296,17 @@ def main(rlm=False, rlm_dir=None):
         print_and_log_scalar(writer, 'train/Gen Loss', gen_losses, writes)      
         print_and_log_scalar(writer, 'train/Disc Loss', disc_losses, writes)      
         print_and_log_scalar(writer, 'train/Critic Loss', critic_losses, writes, end_token='\n')      
+        if rollouts is not None: 
+            print_and_log_scalar(writer, 'train/rollout staleness', rollouts.staleness, writes)
+            print_and_log_scalar(writer, 'train/stale rollouts dropped', rollouts.dropped, writes, end_token='\n')
+            rollouts.staleness, rollouts.dropped = RunningStat(), 0
 
 
-        if (epoch + 1) % args.test_every == 0: 
-            valid_loader  = minibatch_generator(dataset_valid,  args, shuffle=False)
+        if (epoch + 1) % args.test_every == 0 and is_main: 
+            valid_loader  = get_loader(dataset_valid,  args, shuffle=False)
             with torch.no_grad():
                 gen_losses, disc_losses, critic_losses, ps_real, ps_fake, real_accs, \
-                    fake_accs, nlls, oracle_nlls, mixed_nlls, entropy = [[] for _ in range(11)]
+                    fake_accs, nlls, oracle_nlls, mixed_nlls, entropy = [RunningStat() for _ in range(11)]
                 gen.eval(); disc.eval()
 
                 # Test loop
@@ -240,8 +319,8 @@ def main(rlm=False, rlm_dir=None):
                     p_real = F.sigmoid(real_out)
                     real_acc = (p_real[:, -1] >0.5).type(torch.float).mean().data
                     p_real = p_real.mean().data
-                    ps_real += [p_real]
-                    real_accs += [real_acc]
+                    ps_real.update(p_real)
+                    real_accs.update(real_acc)
                     
                                    
                     # disc on fake data
@@ -251,18 +330,18 @@ def main(rlm=False, rlm_dir=None):
                     p_fake = F.sigmoid(fake_out)
                     fake_acc = (p_fake[:, -1] <0.5).type(torch.float).mean().data
                     p_fake = p_fake.mean().data
-                    ps_fake += [p_fake]
-                    fake_accs += [fake_acc]
+                    ps_fake.update(p_fake)
+                    fake_accs.update(fake_acc)
                     disc_loss = (fake_loss + real_loss) / 2
-                    disc_losses += [disc_loss.data]
+                    disc_losses.update(disc_loss.data)
                     import pdb; pdb.set_trace()
-                    entropy += [Categorical(logits=fake_logits.squeeze(1)).entropy()]
+                    entropy.update(Categorical(logits=fake_logits.squeeze(1)).entropy().mean())
                     
                     # critic
                     if args.use_baseline: 
                         cumulative_rewards = get_cumulative_rewards(fake_out, args)
                         critic_loss = reinforce_critic_loss(cumulative_rewards, fake_baseline)
-                        critic_losses += [critic_loss.data]            
+                        critic_losses.update(critic_loss.data)            
                       
                     # generator in free sampling mode
                     fake_logits, fake_sentence = gen(input[:, [0]])
@@ -270,12 +349,11 @@ def main(rlm=False, rlm_dir=None):
                     cumulative_rewards = get_cumulative_rewards(fake_out, args)
                     gen_loss = reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, 
                                                   fake_baseline, args)
-                    gen_losses += [gen_loss.data]
+                    gen_losses.update(gen_loss.data)
 
                     # generator in teacher forcing mode
-                    fake_logits, _  = gen(input)
-                    nll = masked_cross_entropy(fake_logits, target, lens)
-                    nlls += [nll.data]
+                    nll = gen.mle_loss(input, target, lens)
+                    nlls.update(nll.data)
                     
                     if args.lm_path: 
                         # generate a sentence, a sentence, and feed to oracle lm
@@ -283,9 +361,10 @@ def main(rlm=False, rlm_dir=None):
                         oracle_logits, _ = oracle_lm(oracle_input.detach())
                     
                         oracle_nll = NLL(oracle_logits[:, :-1], fake_sentence)
-                        oracle_nlls += [oracle_nll.data] 
+                        oracle_nlls.update(oracle_nll.data) 
                         
-                        mixed_nlls += [(nll.data+oracle_nll.data)/2]
+                        mixed_nlls.update((nll.data+oracle_nll.data)/2)
+                valid_loader.close()
                     
             
                 # logging
@@ -301,6 +380,7 @@ def main(rlm=False, rlm_dir=None):
                 print_and_log_scalar(writer, 'valid/Critic Loss', critic_losses, writes, end_token='\n')      
                 
         writes += 1
+        if not is_main: continue
 
         # save samples
         gen.eval()
@@ -311,6 +391,12 @@ def main(rlm=False, rlm_dir=None):
         if (epoch + 1) % args.save_every == 0: 
             save_models(MODELS, args.base_dir, writes)
 
+        if (epoch + 1) % args.checkpoint_every == 0 or epoch + 1 == args.adv_epochs: 
+            checkpointer.save(training_state('adv', epoch), writes)
+
+    if rollouts is not None: rollouts.close()
+    checkpointer.wait()
+
 
 if __name__ == '__main__':
     main()
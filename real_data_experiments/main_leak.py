@@ -21,22 +21,11 @@ def main(rlm=False, rlm_dir=None):
 
     # small wrapper to sample from model
     def sample_from(model, sample_size, disc=None, size=2048):
-        with torch.no_grad():
-            num_iters = sample_size // size + 1
-            start_token = torch.zeros(size, 1).long() + 2
-            if args.cuda: 
-                start_token = start_token.cuda()
-
-            samples = []
-            for _ in range(num_iters):
-                if disc is not None:
-                    samples += [model(start_token, disc=disc)[1]]
-                else: 
-                    samples += [model(start_token)[1]]
-            
-            samples = torch.cat(samples, dim=0)
-            samples = samples[:sample_size]
-            return samples
+        start_token = torch.zeros(size, 1).long() + 2
+        if args.cuda: 
+            start_token = start_token.cuda()
+
+        return sample_many(model, start_token, sample_size, disc=disc)
 
     def disc_pretrain_epoch(fake_dataset=None):
         # if in Leak(ish) Gan setup, perform disc pretraining prior to MLE
@@ -106,7 +95,7 @@ def main(rlm=False, rlm_dir=None):
             input, target, len = minibatch
 
             # provide discriminator for leak signal (if args.leak_info is True)
-            gen_logits, _ = gen(input, disc=disc)
+            gen_logits, _ = gen(input, disc=disc, lengths=len)
             loss = masked_cross_entropy(gen_logits, target, len)
             losses += [loss.data]
             
@@ -339,7 +328,7 @@ def main(rlm=False, rlm_dir=None):
                 apply_loss(optimizer_gen, gen_loss, clip_norm=args.grad_clip)
 
             if should_train_mle:
-                fake_logits, _  = gen(input)
+                fake_logits, _  = gen(input, lengths=lens)
                 nll = masked_cross_entropy(fake_logits, target, lens)
                 nlls += [nll.data]
                 
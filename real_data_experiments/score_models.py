@@ -39,8 +39,7 @@ gen, loaded_epoch = load_model_from_file(args.model_path, epoch=args.model_epoch
 gen.eval()
 
 # Logging
-writer = tensorboardX.SummaryWriter(log_dir=os.path.join(args.model_path, \
-        'TB'))
+writer = get_writer(os.path.join(args.model_path, 'TB'), args.log_backend)
 writes = 0
 
 if args.lm_path: 
@@ -51,104 +50,87 @@ if args.cuda:
     gen  = gen.cuda()
     if args.lm_path: oracle_lm = oracle_lm.cuda()
 
-MODE = [('free_running', test_batch, OD(), [], [])]
-
 TEMPERATURES = [0.9, 0.95, 1.0, 1.03, 1.06, 1.09, 1.12, 1.15, 1.20,
                 1.25, 1.30, 1.35, 1.40, 1.50, 1.60, 1.70, 1.8, 1.9, 2.0, 3.0, 4.0 ]
 
 TEMPERATURES = [0.2, 0.3, 0.4, 0.5, 0.6, 0.70, 0.75, 0.8, 0.85 ]
-
-
-for alpha in TEMPERATURES:
+TOP_KS       = [1, 2, 5, 10, 20, 50, 100, 500, 1000]
+TOP_PS       = [0.1, 0.2, 0.4, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+TYPICAL_PS   = [0.1, 0.2, 0.4, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+SWEEP_BATCH_SIZE = 10000 # max rows per stacked sampling batch
+
+input, _, _ = test_batch
+
+# samples are scored under the oracle as they are generated (see `score_free_running`)
+with torch.no_grad():
+    bs = input.size(0)
+    if args.sweep == 'temperature': 
+        # every temperature is sampled in the same (stacked) batch
+        SWEEP = TEMPERATURES
+        alpha = torch.tensor(TEMPERATURES, device=input.device)
+        alpha = alpha.view(-1, 1, 1, 1).expand(-1, bs, 1, 1).reshape(-1, 1, 1)
+        words, _, avg_nlls, _ = score_free_running(gen, oracle_lm, bs * len(SWEEP), alpha=alpha, 
+                seq_len=args.tsne_max_t, start=input[:, [0]].repeat(len(SWEEP), 1), 
+                max_batch_size=SWEEP_BATCH_SIZE)
+        all_fake_sentences = list(words.view(len(SWEEP), bs, -1))
+        all_avg_nlls       = list(avg_nlls.view(len(SWEEP), bs))
+    else: 
+        SWEEP = {'top_k': TOP_KS, 'top_p': TOP_PS, 'typical_p': TYPICAL_PS}[args.sweep]
+        all_fake_sentences, all_avg_nlls = [], []
+        for value in SWEEP: 
+            gen.decoding = DecodingStrategy(**{args.sweep: value})
+            words, _, avg_nlls, _ = score_free_running(gen, oracle_lm, bs, seq_len=args.tsne_max_t, 
+                    start=input[:, [0]])
+            all_fake_sentences += [words]
+            all_avg_nlls       += [avg_nlls]
+
+# logging names / steps of the swept values
+sweep_name = 'alpha' if args.sweep == 'temperature' else args.sweep
+sweep_tag  = 'eval' if args.sweep == 'temperature' else 'eval_{}'.format(args.sweep)
+sweep_step = lambda value : value if args.sweep == 'top_k' else int(value * 100)
+
+
+for alpha, fake_sentences, avg_oracle_nll in zip(SWEEP, all_fake_sentences, all_avg_nlls):
 
     with torch.no_grad():
-        for mode, data, hs_dict, oracle_nlls, embeddings in MODE: 
-            input, _, _ = data
-
-            # here we basically expose the model's forward pass to fetch the hidden states efficiently
-            teacher_force = mode != 'free_running'
-            print('teacher forcing : {}'.format(teacher_force))
-            hidden_state, hidden_state_oracle = None, None
-
-            for t in range(args.tsne_max_t):
-                if teacher_force or t == 0: 
-                    input_idx = input[:, [t]]
-
-                input_t = gen.embedding(input_idx)
-                output, hidden_state = gen.step(input_t, hidden_state, t)
-                embeddings += [input_t.cpu().data.numpy()]
-                
-                if args.lm_path: 
-                    if t > 0: 
-                        # query the oracle for NLL of the next word (i.e. use x_t to index p(x_t | x_{i<t})
-                        # oracle_nlls += [-1. * oracle_dist.log_prob(input_idx.squeeze()).mean(dim=0).item()]
-                        oracle_nll_t = -1. * oracle_dist.log_prob(input_idx.squeeze())
-                        oracle_nlls += [remove_pad_tokens(oracle_nll_t, input_idx.squeeze()).item()]
-                        full_oracle_nll = oracle_nll_t.view(-1,1) if t==1 \
-                            else torch.cat((full_oracle_nll,oracle_nll_t.view(-1,1)),1)
-
-                    # feed the current word to the model. 
-                    input_oracle = oracle_lm.embedding(input_idx)
-                    output_oracle, hidden_state_oracle = oracle_lm.step(input_oracle, \
-                            hidden_state_oracle, t)
-                    oracle_dist = oracle_lm.output_layer(output_oracle)
-                    oracle_dist = Categorical(logits=oracle_dist.squeeze(1))
-               
-                if not teacher_force: 
-                    dist = gen.output_layer(output)
-                    dist *= alpha
-                    input_idx = Categorical(logits=dist.squeeze(1)).sample().unsqueeze(1)
-                    fake_sentences = input_idx if t==0 else torch.cat((fake_sentences,input_idx), 1)
-
-                if (t+1) % args.tsne_log_every == 0: 
-                    # for lstm we take the hidden state (i.e. h_t of (h_t, c_t))
-                    hs = hidden_state[0] if isinstance(hidden_state, tuple) else hidden_state
-                    hs_dict[t] = hs.cpu().data.numpy()
-
-                if (t+1) % args.oracle_nll_log_every == 0 and args.lm_path and t > 0: 
-                    p_x_1t = sum(oracle_nlls)
-                    p_x_t = oracle_nlls[-1]
-
-            # print most/less likely sequences
-            seq = input[:,1:] if teacher_force else fake_sentences
-            seq_len = (seq != 0).sum(1)
-            tot_oracle_nll = full_oracle_nll.sum(1)
-            avg_oracle_nll = tot_oracle_nll.cpu().numpy() / seq_len.cpu().numpy()
-
-            sentences = id_to_words(seq.cpu().data.numpy(), word_dict)
-            sorted_idx = np.argsort(avg_oracle_nll)
+        # print most/less likely sequences
+        seq = fake_sentences
+        avg_oracle_nll = avg_oracle_nll.cpu().numpy()
+
+        sentences = id_to_words(seq.cpu().data.numpy(), word_dict)
+        sorted_idx = np.argsort(avg_oracle_nll)
+    
+        if args.character_level: sentences = remove_sep_spaces(sentences)
         
-            if args.character_level: sentences = remove_sep_spaces(sentences)
-            
-            print("most likely sentences under oracle: \n")
-            for i in range(3):
-                print(sentences[sorted_idx[i]])
-                print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[i]]))
-            
-            print("least likely sentences under oracle: \n ")
-            for i in range(1,3):
-                print(sentences[sorted_idx[-i]])
-                print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[-i]]))
+        print("most likely sentences under oracle: \n")
+        for i in range(3):
+            print(sentences[sorted_idx[i]])
+            print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[i]]))
+        
+        print("least likely sentences under oracle: \n ")
+        for i in range(1,3):
+            print(sentences[sorted_idx[-i]])
+            print("nll oracle: {:.4f}".format(avg_oracle_nll[sorted_idx[-i]]))
 
-            print('some samples \n')
-            for i in range(1,3):
-                print(sentences[-i])
-                print("nll oracle: {:.4f}".format(avg_oracle_nll[-i]))
+        print('some samples \n')
+        for i in range(1,3):
+            print(sentences[-i])
+            print("nll oracle: {:.4f}".format(avg_oracle_nll[-i]))
 
     ######  LM score   ######
     lm_score = np.mean(avg_oracle_nll)
-    print_and_log_scalar(writer, 'eval/lm_score', lm_score, int(alpha*100))
+    print_and_log_scalar(writer, '{}/lm_score'.format(sweep_tag), lm_score, sweep_step(alpha))
 
     ##### RLM SCORE ######
 
     # save the generated sequences somewhere 
-    rlm_dir = os.path.join(args.model_path,"rlm_alpha{}".format(alpha))
+    rlm_dir = os.path.join(args.model_path,"rlm_{}{}".format(sweep_name, alpha))
     print_and_save_samples(fake_sentences, 
             word_dict, rlm_dir, for_rlm=True, split='train', breakdown=10)
     
     rlm_score = main(rlm=True, rlm_dir=rlm_dir)
     
-    print_and_log_scalar(writer, 'eval/rlm_score', rlm_score, int(alpha*100))
+    print_and_log_scalar(writer, '{}/rlm_score'.format(sweep_tag), rlm_score, sweep_step(alpha))
     
     # delete the dataset
     command="rm {}".format(os.path.join(rlm_dir,'train.txt'))
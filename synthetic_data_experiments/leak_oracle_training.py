@@ -55,22 +55,11 @@ def main(args=None, max_writes=1e5):
 
     # small wrapper to sample from model
     def sample_from(model, sample_size, disc=None):
-        with torch.no_grad():
-            num_iters = sample_size // 512 + 1
-            start_token = torch.zeros(512, 1).long()
-            if args.cuda: 
-                start_token = start_token.cuda()
-
-            samples = []
-            for _ in range(num_iters):
-                if disc is not None:
-                    samples += [model(start_token, disc=disc)[1]]
-                else: 
-                    samples += [model(start_token)[1]]
-            
-            samples = torch.cat(samples, dim=0)
-            samples = samples[:sample_size]
-            return samples
+        start_token = torch.zeros(512, 1).long()
+        if args.cuda: 
+            start_token = start_token.cuda()
+
+        return sample_many(model, start_token, sample_size, disc=disc)
         
     dataset_train = sample_from(oracle, args.num_oracle_samples)
     dataset_test  = sample_from(oracle, args.num_oracle_samples_test)
@@ -15,6 +15,7 @@ from common.losses import *
 from common.args   import * 
 
 TEMPERATURES = np.arange(0.7, 2.5, 0.03)
+SWEEP_BATCH_SIZE = 20000 # max rows per stacked sampling batch
 
 # wrapper for loss
 NLL = lambda logits, target: F.cross_entropy(logits.reshape(-1, logits.size(-1)), target.flatten())
@@ -25,22 +26,11 @@ np.random.seed(1994)
 
 # small wrapper to sample from model
 def sample_from(model, sample_size, disc=None, cuda=True):
-    with torch.no_grad():
-        num_iters = sample_size // 2000 + 1
-        start_token = torch.zeros(2000, 1).long()
-        if cuda: 
-            start_token = start_token.cuda()
+    start_token = torch.zeros(2000, 1).long()
+    if cuda: 
+        start_token = start_token.cuda()
 
-        samples = []
-        for _ in range(num_iters):
-            if disc is not None:
-                samples += [model(start_token, disc=disc)[1]]
-            else: 
-                samples += [model(start_token)[1]]
-        
-        samples = torch.cat(samples, dim=0)
-        samples = samples[:sample_size]
-        return samples
+    return sample_many(model, start_token, sample_size, disc=disc)
 
 
 # build a new test set from oracle
@@ -87,39 +77,34 @@ class Model_eval:
     def eval_gen(self):
         with torch.no_grad():
             start_token = torch.cuda.LongTensor(1000, 1).fill_(0) # SOS Token
-            oracle_temp_nlls = {}      
-            test_temp_nlls   = {}    
-
-            for alpha in TEMPERATURES:
-                oracle_nlls, test_nlls = [], []
-                gen, disc = self.gen, self.disc
-                gen.eval(); disc.eval()
-                assert not gen.training
-
-                gen.args.alpha_test = alpha; 
-                assert gen.args.alpha_test == alpha
-            
-                for i in range(10): # 10k 
-                    gen_sample = gen(start_token, disc=disc)[1]
+            oracle_temp_nlls = {alpha : [] for alpha in TEMPERATURES}
+            test_temp_nlls   = {alpha : [] for alpha in TEMPERATURES}
+
+            gen, disc = self.gen, self.disc
+            gen.eval(); disc.eval()
+            assert not gen.training
+
+            for i in range(10): # 10k 
+                # every temperature is sampled in the same (stacked) batch
+                gen_samples = gen.temperature_samples(start_token, TEMPERATURES, disc=disc, 
+                                                      max_batch_size=SWEEP_BATCH_SIZE)
+                for alpha, gen_sample in zip(TEMPERATURES, gen_samples):
                     oracle_input = torch.cat([start_token, gen_sample], dim=1)
                     oracle_logits = oracle(oracle_input)[0]
                     oracle_nll = NLL(oracle_logits[:, :-1], gen_sample)
-                    oracle_nlls += [oracle_nll.item()]
-
-                oracle_temp_nlls[alpha] = np.mean(oracle_nlls)
+                    oracle_temp_nlls[alpha] += [oracle_nll.item()]
 
-                for minibatch in test_loader: 
-                    input = torch.cat([start_token, minibatch[:, :-1]], dim=1)
-                    target = minibatch
+            for minibatch in test_loader: 
+                input = torch.cat([start_token, minibatch[:, :-1]], dim=1)
+                target = minibatch
 
-                    gen_logits = gen(input, disc=disc)[0]
+                # teacher forced hidden states do not depend on alpha : only rescale the logits
+                for alpha, gen_logits in gen.temperature_logits(input, TEMPERATURES, disc=disc):
                     test_nll = NLL(gen_logits, target)
-                    test_nlls += [test_nll.item()]
-
-                test_temp_nlls[alpha] = np.mean(test_nlls)
+                    test_temp_nlls[alpha] += [test_nll.item()]
 
-        self.nll_test = test_temp_nlls
-        self.nll_oracle = oracle_temp_nlls  
+        self.nll_test = {alpha : np.mean(nlls) for (alpha, nlls) in test_temp_nlls.items()}
+        self.nll_oracle = {alpha : np.mean(nlls) for (alpha, nlls) in oracle_temp_nlls.items()}
         print('oracle nll')
         print(self.nll_oracle)
 
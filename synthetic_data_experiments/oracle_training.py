@@ -3,6 +3,7 @@ import pdb
 import numpy as np
 import torch
 import torch.utils.data
+import torch.utils.data.distributed
 import torch.optim as optim
 import tensorboardX
 import __init__
@@ -21,6 +22,8 @@ def main(args=None, max_writes=1e5):
     # reproducibility
     torch.manual_seed(2)
     np.random.seed(2)
+    init_distributed(args)
+    is_main = args.rank == 0
 
     # add extra args
     args.vocab_size = 5000
@@ -29,23 +32,26 @@ def main(args=None, max_writes=1e5):
     args.num_oracle_samples_test = 5000
     args.cuda = False if args.no_cuda else True
 
-    # Logging
-    maybe_create_dir(args.base_dir)
-    maybe_create_dir(os.path.join(args.base_dir, 'models'))
-    print_and_save_args(args, args.base_dir)
-    writer = tensorboardX.SummaryWriter(log_dir=os.path.join(args.base_dir, 'TB'))
+    # Logging (only done by the first process in distributed mode)
+    if is_main: 
+        maybe_create_dir(args.base_dir)
+        maybe_create_dir(os.path.join(args.base_dir, 'models'))
+        print_and_save_args(args, args.base_dir)
+    writer = get_writer(os.path.join(args.base_dir, 'TB'), args.log_backend) if is_main else NullWriter()
     writes = 0
 
     oracle = get_oracle(args)
     gen  = Generator(args)
     disc = Generator(get_cot_args(args)) if args.cot else Discriminator(args)
-    print('generator', gen, '\ndiscriminator', disc)
+    if is_main: print('generator', gen, '\ndiscriminator', disc)
 
     if args.cuda: 
         gen  = gen.cuda()
         disc = disc.cuda()
         oracle = oracle.cuda()
 
+    broadcast_params([gen, disc])
+
     optimizer_gen = optim.Adam(gen.parameters(), lr=args.gen_lr)
 
     if args.cot:  
@@ -70,7 +76,16 @@ def main(args=None, max_writes=1e5):
     sentences = torch.cat(sentences, dim=0).cpu().data.numpy()
     dataset_train = sentences[:args.num_oracle_samples]
     dataset_test  = sentences[args.num_oracle_samples:args.num_oracle_samples+args.num_oracle_samples_test]
-    train_loader = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True)
+
+    # every process gets its own share of the (same) synthetic data, and draws different samples
+    if args.world_size > 1: 
+        train_sampler = torch.utils.data.distributed.DistributedSampler(dataset_train, 
+                num_replicas=args.world_size, rank=args.rank)
+        train_loader = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, sampler=train_sampler)
+        torch.manual_seed(2 + args.rank)
+    else: 
+        train_sampler = None
+        train_loader = torch.utils.data.DataLoader(dataset_train, batch_size=args.batch_size, shuffle=True)
     test_loader  = torch.utils.data.DataLoader(dataset_test,   batch_size=1000, shuffle=False)
 
     # wrapper for loss
@@ -81,8 +96,9 @@ def main(args=None, max_writes=1e5):
     '''
     for epoch in range(args.mle_epochs):
         print('MLE pretraining epoch {}/{}'.format(epoch, args.mle_epochs))
-        losses_train, losses_test, oracle_nlls = [], [], []
+        losses_train, losses_test, oracle_nlls = RunningStat(), RunningStat(), RunningStat()
         gen.train()
+        if train_sampler is not None: train_sampler.set_epoch(epoch)
 
         # Training loop
         for i, minibatch in enumerate(train_loader):
@@ -96,12 +112,12 @@ def main(args=None, max_writes=1e5):
             # provide discriminator for leak signal (if args.leak_info is True)
             gen_logits, _ = gen(input, disc=disc)
             loss = NLL(gen_logits, target)
-            losses_train += [loss.data]
+            losses_train.update(loss.data)
             apply_loss(optimizer_gen, loss, clip_norm=args.grad_clip)
         
         print_and_log_scalar(writer, 'train/nll', losses_train, writes, end_token='\n')
 
-        if (epoch + 1) % args.test_every == 0 :
+        if (epoch + 1) % args.test_every == 0 and is_main:
             with torch.no_grad():
                 for i, minibatch in enumerate(test_loader):
                     if args.cuda: 
@@ -113,7 +129,7 @@ def main(args=None, max_writes=1e5):
              
                     gen_logits, _ = gen(input, disc=disc)
                     loss = NLL(gen_logits, target)
-                    losses_test += [loss.data]
+                    losses_test.update(loss.data)
 
                 start_token = start_token[[0]].expand(1000, -1)
                 # generate a sentence, a sentence, and feed to oracle lm
@@ -123,9 +139,9 @@ def main(args=None, max_writes=1e5):
                 oracle_logits, _ = oracle(oracle_input.detach())
                         
                 nll = NLL(oracle_logits[:, :-1], gen_sample)
-                oracle_nlls += [nll.data] 
+                oracle_nlls.update(nll.data) 
                 
-                final_obj = oracle_nlls[0].mean() + torch.stack(losses_test).mean()
+                final_obj = oracle_nlls.mean + losses_test.mean
 
                 print_and_log_scalar(writer, 'test/oracle_nll', oracle_nlls, writes)
                 print_and_log_scalar(writer, 'test/nll', losses_test, writes)
@@ -145,8 +161,9 @@ def main(args=None, max_writes=1e5):
     for epoch in range(args.adv_epochs):
         print('ADV training epoch {}'.format(epoch))
         gen_losses, disc_losses, critic_losses, ps_real, ps_fake, real_accs, fake_accs, nlls, \
-                cot_real_loss, cot_fake_loss = [[] for _ in range(10)]
+                cot_real_loss, cot_fake_loss = [RunningStat() for _ in range(10)]
         gen.train(); disc.train()
+        if train_sampler is not None: train_sampler.set_epoch(args.mle_epochs + epoch)
 
         # Training loop
         for i, minibatch in enumerate(train_loader):
@@ -164,15 +181,15 @@ def main(args=None, max_writes=1e5):
                 if args.cot:
                     real_logits, _ = disc(input)
                     real_loss = NLL(real_logits, target)
-                    cot_real_loss += [real_loss.data]
+                    cot_real_loss.update(real_loss.data)
                 else:
                     real_out, _  = disc(target)
                     real_loss = F.binary_cross_entropy_with_logits(real_out, torch.ones_like(real_out))
                     p_real = F.sigmoid(real_out)
                     real_acc = (p_real[:, -1] > 0.5).type(torch.float).mean().data
                     p_real = p_real.mean().data
-                    ps_real += [p_real]
-                    real_accs += [real_acc]
+                    ps_real.update(p_real)
+                    real_accs.update(real_acc)
                                
                 # train disc on fake data
                 _, fake_sentences = gen(input[:, [0]], disc=disc)
@@ -180,18 +197,18 @@ def main(args=None, max_writes=1e5):
                     # prepend sos_token to generated sentence
                     fake_logits, _ = disc(torch.cat([input[:, [0]], fake_sentences[:, :-1]], dim=1))
                     fake_loss = NLL(fake_logits, fake_sentences)
-                    cot_fake_loss += [fake_loss.data]
+                    cot_fake_loss.update(fake_loss.data)
                 else:
                     fake_out, fake_baseline = disc(fake_sentences.detach())
                     fake_loss = F.binary_cross_entropy_with_logits(fake_out, torch.zeros_like(fake_out))
                     p_fake = F.sigmoid(fake_out)
                     fake_acc = (p_fake[:, -1] < 0.5).type(torch.float).mean().data
                     p_fake = p_fake.mean().data
-                    ps_fake += [p_fake]
-                    fake_accs += [fake_acc]
+                    ps_fake.update(p_fake)
+                    fake_accs.update(fake_acc)
                 
                 disc_loss = (fake_loss + real_loss) / 2
-                disc_losses += [disc_loss.data]
+                disc_losses.update(disc_loss.data)
 
                 apply_loss(optimizer_disc, disc_loss, clip_norm=args.grad_clip)
                 
@@ -199,7 +216,7 @@ def main(args=None, max_writes=1e5):
                 if args.use_baseline and not args.cot: 
                     cumulative_rewards = get_cumulative_rewards(fake_out, args)
                     critic_loss = reinforce_critic_loss(cumulative_rewards, fake_baseline)
-                    critic_losses += [critic_loss.data]            
+                    critic_losses.update(critic_loss.data)            
 
                     apply_loss(optimizer_critic, critic_loss, clip_norm=args.grad_clip)
             
@@ -216,14 +233,14 @@ def main(args=None, max_writes=1e5):
                     gen_loss = reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, 
                                               fake_baseline, args)
                 
-                gen_losses += [gen_loss.data]
+                gen_losses.update(gen_loss.data)
 
                 apply_loss(optimizer_gen, gen_loss, clip_norm=args.grad_clip)
 
             if should_train_mle:
                 fake_logits, _  = gen(input, disc=disc)
                 nll = NLL(fake_logits, target)
-                nlls += [nll.data]
+                nlls.update(nll.data)
                 
                 apply_loss(optimizer_gen, nll, clip_norm=args.grad_clip)
             
@@ -241,10 +258,10 @@ def main(args=None, max_writes=1e5):
         print_and_log_scalar(writer, 'train/CoT Fake Loss', cot_fake_loss, writes, end_token='\n')      
 
 
-        if (epoch + 1) % args.test_every == 0: 
+        if (epoch + 1) % args.test_every == 0 and is_main: 
             with torch.no_grad():
                 gen_losses, disc_losses, critic_losses, ps_real, ps_fake, real_accs, fake_accs, nlls, \
-                        oracle_nlls, cot_real_loss, cot_fake_loss = [[] for _ in range(11)]
+                        oracle_nlls, cot_real_loss, cot_fake_loss = [RunningStat() for _ in range(11)]
                 gen.eval(); disc.eval()
 
                 # Test loop
@@ -260,15 +277,15 @@ def main(args=None, max_writes=1e5):
                     if args.cot:
                         real_logits, _ = disc(input)
                         real_loss = NLL(real_logits, target)
-                        cot_real_loss += [real_loss.data]
+                        cot_real_loss.update(real_loss.data)
                     else:
                         real_out, _  = disc(target)
                         real_loss = F.binary_cross_entropy_with_logits(real_out, torch.ones_like(real_out))
                         p_real = F.sigmoid(real_out)
                         real_acc = (p_real[:, -1] > 0.5).type(torch.float).mean().data
                         p_real = p_real.mean().data
-                        ps_real += [p_real]
-                        real_accs += [real_acc]
+                        ps_real.update(p_real)
+                        real_accs.update(real_acc)
                         
                                    
                     # disc on fake data
@@ -277,24 +294,24 @@ def main(args=None, max_writes=1e5):
                         # prepend sos_token to generated sentence
                         fake_logits, _ = disc(torch.cat([input[:, [0]], fake_sentences[:, :-1]], dim=1))
                         fake_loss = NLL(fake_logits, fake_sentences)
-                        cot_fake_loss += [fake_loss.data]
+                        cot_fake_loss.update(fake_loss.data)
                     else:
                         fake_out, fake_baseline = disc(fake_sentences.detach())
                         fake_loss = F.binary_cross_entropy_with_logits(fake_out, torch.zeros_like(fake_out))
                         p_fake = F.sigmoid(fake_out)
                         fake_acc = (p_fake[:, -1] < 0.5).type(torch.float).mean().data
                         p_fake = p_fake.mean().data
-                        ps_fake += [p_fake]
-                        fake_accs += [fake_acc]
+                        ps_fake.update(p_fake)
+                        fake_accs.update(fake_acc)
                     
                     disc_loss = (fake_loss + real_loss) / 2
-                    disc_losses += [disc_loss.data]
+                    disc_losses.update(disc_loss.data)
                     
                     # critic
                     if args.use_baseline and not args.cot: 
                         cumulative_rewards = get_cumulative_rewards(fake_out, args)
                         critic_loss = reinforce_critic_loss(cumulative_rewards, fake_baseline)
-                        critic_losses += [critic_loss.data]            
+                        critic_losses.update(critic_loss.data)            
                       
                     # generator in free sampling mode
                     fake_logits, fake_sentence = gen(input[:, [0]], disc=disc)
@@ -305,20 +322,20 @@ def main(args=None, max_writes=1e5):
                         cumulative_rewards = get_cumulative_rewards(fake_out, args)
                         gen_loss = reinforce_gen_loss(cumulative_rewards, fake_logits, fake_sentence, 
                                                   fake_baseline, args)
-                    gen_losses += [gen_loss.data]
+                    gen_losses.update(gen_loss.data)
 
                     # generator in teacher forcing mode
                     fake_logits, _  = gen(input, disc=disc)
                     nll = NLL(fake_logits, target)
-                    nlls += [nll.data]
+                    nlls.update(nll.data)
 
                     # oracle nll
                     oracle_input = torch.cat([start_token, fake_sentence], dim=1)
                     oracle_logits, _ = oracle(oracle_input)
                     oracle_nll = NLL(oracle_logits[:, :-1], fake_sentence)
-                    oracle_nlls += [oracle_nll.data] 
+                    oracle_nlls.update(oracle_nll.data) 
 
-                final_obj = sum([x + y for (x,y) in zip(oracle_nlls, nlls)]) / len(nlls)
+                final_obj = oracle_nlls.mean + nlls.mean
  
                 # logging
                 print_and_log_scalar(writer, 'test/oracle_nll', oracle_nlls, writes)
@@ -338,7 +355,7 @@ def main(args=None, max_writes=1e5):
         if writes > max_writes: return gen, disc
 
         # save models
-        if (epoch + 1) % args.save_every == 0: 
+        if (epoch + 1) % args.save_every == 0 and is_main: 
             save_models(MODELS, args.base_dir, writes)
 
     return gen, disc